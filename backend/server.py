@@ -1,8 +1,14 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Query
 from fastapi.security import HTTPBearer
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.routing import Match
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import PyMongoError, OperationFailure, BulkWriteError, DuplicateKeyError
+from gridfs.errors import NoFile
+from bson import ObjectId
 import os
 import logging
 from pathlib import Path
@@ -12,27 +18,589 @@ import uuid
 from datetime import datetime, timezone, timedelta
 import hashlib
 import secrets
+import base64
+import binascii
+import json
+import csv
+import re
+import io
+import time
+import asyncio
+import bisect
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from PIL import Image, ImageOps, UnidentifiedImageError
 import jwt
 import bcrypt
 import httpx
 import random
+import math
+import numpy as np
+import pandas as pd
+import pymongo
+from pymongo import monitoring
+import threading
+import contextvars
+import sys
+import importlib.util
+from contextlib import asynccontextmanager, contextmanager
+import tracemalloc
+import linecache
+
+# Import time counts towards startup; pandas and numpy alone take a while
+IMPORT_STARTED = time.perf_counter()
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# ==================== METRICS ====================
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class _Metric:
+    """One labelled Prometheus metric family.
+
+    Values are plain dicts keyed by label tuples, guarded by a lock since
+    Mongo events are recorded from the driver's threads.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, Any] = {}
+
+    def _labels(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{n}="{_escape_label(str(v))}"' for n, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _render_value(self, labels: tuple, value) -> List[str]:
+        return [f"{self.name}{self._labels(labels)} {value}"]
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    def set(self, labels: tuple, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_value(self, labels: tuple, value) -> List[str]:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, hits in zip(self.buckets + (float("inf"),), counts):
+            cumulative += hits
+            le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+            lines.append(f"{self.name}_bucket{self._labels(labels, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(labels)} {total}")
+        lines.append(f"{self.name}_count{self._labels(labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Minimal Prometheus registry; each worker process exposes its own"""
+
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """Register a function that refreshes gauges just before rendering"""
+        self.collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics_registry = MetricsRegistry()
+http_requests = metrics_registry.register(Counter(
+    "http_requests_total", "HTTP requests by route template, method and status", ("route", "method", "status")
+))
+http_request_duration = metrics_registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("route", "method")
+))
+http_in_flight = metrics_registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests currently being served", ("route", "method")
+))
+mongo_command_duration = metrics_registry.register(Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency by collection and command",
+    ("collection", "command"), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+))
+mongo_command_failures = metrics_registry.register(Counter(
+    "mongo_command_failures_total", "Failed MongoDB commands", ("collection", "command")
+))
+mongo_checkout_wait = metrics_registry.register(Histogram(
+    "mongo_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+))
+mongo_checkout_failures = metrics_registry.register(Counter(
+    "mongo_pool_checkout_failures_total", "Failed connection checkouts", ("address",)
+))
+cache_requests = metrics_registry.register(Counter(
+    "cache_requests_total", "In-process cache lookups by outcome", ("cache", "result")
+))
+
+# Set for the duration of a profiled request; Motor copies context into its
+# executor threads, so command events can attribute Mongo time to it
+current_profile: contextvars.ContextVar = contextvars.ContextVar("current_profile", default=None)
+
+# Route template of the request being served, for attributing slow queries;
+# work started outside a request keeps the default
+current_route: contextvars.ContextVar = contextvars.ContextVar("current_route", default="background")
+
+class LatencyStats:
+    """Count, total, max and a fixed-bucket histogram of durations in ms"""
+
+    BOUNDS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(self.BOUNDS_MS) + 1)
+
+    def observe(self, ms: float, failed: bool = False):
+        self.count += 1
+        self.failures += failed
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect.bisect_left(self.BOUNDS_MS, ms)] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, hits in zip(self.BOUNDS_MS + (None,), self.buckets):
+            seen += hits
+            if seen >= rank:
+                return bound if bound is not None else self.max_ms
+        return self.max_ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+        }
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool usage, fed by pymongo's CMAP events.
+
+    Events fire on the driver's threads, so state is guarded by a lock.
+    Checkout wait is timed between the check-out-started and checked-out
+    events, which pymongo raises on the same thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.in_use: Dict[str, int] = defaultdict(int)
+        self.open: Dict[str, int] = defaultdict(int)
+        self.peak_in_use: Dict[str, int] = defaultdict(int)
+        self.checkout_failures: Dict[str, int] = defaultdict(int)
+        self.checkout_wait = LatencyStats()
+        self.pools_cleared = 0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        address = "%s:%s" % event.address
+        waited = time.perf_counter() - started if started is not None else None
+        if waited is not None:
+            mongo_checkout_wait.observe((), waited)
+        with self._lock:
+            if waited is not None:
+                self.checkout_wait.observe(waited * 1000)
+            self.in_use[address] += 1
+            self.peak_in_use[address] = max(self.peak_in_use[address], self.in_use[address])
+
+    def connection_check_out_failed(self, event):
+        started = getattr(self._local, "started", None)
+        mongo_checkout_failures.inc(("%s:%s" % event.address,))
+        with self._lock:
+            if started is not None:
+                self.checkout_wait.observe((time.perf_counter() - started) * 1000, failed=True)
+            self.checkout_failures["%s:%s" % event.address] += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use["%s:%s" % event.address] -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open["%s:%s" % event.address] += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open["%s:%s" % event.address] -= 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pools_cleared += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_use": dict(self.in_use),
+                "peak_in_use": dict(self.peak_in_use),
+                "open": dict(self.open),
+                "checkout_failures": dict(self.checkout_failures),
+                "checkout_wait": self.checkout_wait.snapshot(),
+                "pools_cleared": self.pools_cleared,
+            }
+
+class CommandMetrics(monitoring.CommandListener):
+    """Per-command latency from pymongo's command monitoring events.
+
+    The collection and command body are only present on the started event,
+    so they are held by request id until the command finishes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands: Dict[str, LatencyStats] = defaultdict(LatencyStats)
+        self._started: Dict[tuple, tuple] = {}
+
+    @staticmethod
+    def _key(event) -> tuple:
+        return (event.connection_id, event.request_id)
+
+    def started(self, event):
+        target = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        with self._lock:
+            self._started[self._key(event)] = (target if isinstance(target, str) else "", event.command)
+
+    def _finish(self, event, failed: bool):
+        with self._lock:
+            collection, command = self._started.pop(self._key(event), ("", None))
+            self.commands[event.command_name].observe(event.duration_micros / 1000, failed=failed)
+        mongo_command_duration.observe((collection, event.command_name), event.duration_micros / 1_000_000)
+        if failed:
+            mongo_command_failures.inc((collection, event.command_name))
+        profile = current_profile.get()
+        if profile is not None:
+            profile.record_mongo(collection, event.command_name, event.duration_micros / 1000)
+        if command is not None and collection:
+            slow_query_log.observe(event, collection, command, failed)
+
+    def succeeded(self, event):
+        self._finish(event, False)
+
+    def failed(self, event):
+        self._finish(event, True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {name: stats.snapshot() for name, stats in sorted(self.commands.items())}
+
+# ==================== SLOW QUERY LOG ====================
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS = 300
+SLOW_QUERY_BUFFER_SIZE = int(os.environ.get('SLOW_QUERY_BUFFER_SIZE', 200))
+SLOW_QUERY_MAX_SHAPES = 500
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+# Session and routing fields the driver adds that explain must not carry
+EXPLAIN_STRIPPED_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+
+def redact_shape(value):
+    """Keep keys and operators, replace every value with "?".
+
+    Lists of scalars (an $in, a batch of ids) collapse to one "?" so they
+    don't split a shape by length; lists of sub-documents ($or, $and)
+    keep their structure.
+    """
+    if isinstance(value, dict):
+        return {key: redact_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        nested = [redact_shape(item) for item in value if isinstance(item, (dict, list, tuple))]
+        return nested or "?"
+    return "?"
+
+def command_shape(name: str, command: Dict[str, Any]) -> Dict[str, Any]:
+    """Redacted filter, sort and pipeline of a command; sort directions are kept"""
+    if name == "find":
+        return {"filter": redact_shape(command.get("filter", {})), "sort": command.get("sort")}
+    if name == "aggregate":
+        return {"pipeline": [
+            {stage: (body if stage == "$sort" else redact_shape(body)) for stage, body in step.items()}
+            for step in command.get("pipeline", [])
+        ]}
+    if name in ("count", "distinct"):
+        return {"filter": redact_shape(command.get("query", {})), "key": command.get("key")}
+    if name == "findAndModify":
+        return {"filter": redact_shape(command.get("query", {})), "sort": command.get("sort")}
+    if name in ("update", "delete"):
+        statements = command.get(name + "s") or [{}]
+        return {"filter": redact_shape(statements[0].get("q", {})), "statements": len(statements)}
+    return {}
+
+def plan_summary(explain: Dict[str, Any]) -> Dict[str, Any]:
+    """Stages and indexes of the winning plan, wherever the explain nests it"""
+    def find_plan(node):
+        if isinstance(node, dict):
+            if "winningPlan" in node:
+                return node["winningPlan"]
+            children = node.values()
+        elif isinstance(node, list):
+            children = node
+        else:
+            return None
+        for child in children:
+            plan = find_plan(child)
+            if plan is not None:
+                return plan
+        return None
+    
+    stages, indexes = [], []
+    def walk(node):
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            if "indexName" in node:
+                indexes.append(node["indexName"])
+            for key in ("queryPlan", "inputStage", "inputStages"):
+                if key in node:
+                    walk(node[key])
+        elif isinstance(node, list):
+            for child in node:
+                walk(child)
+    
+    walk(find_plan(explain))
+    return {"stages": stages, "indexes": indexes, "collscan": "COLLSCAN" in stages}
+
+class SlowQueryLog:
+    """Commands slower than SLOW_QUERY_MS, recent and grouped by query shape.
+
+    Events arrive on Motor's executor threads, so explains are scheduled
+    back onto the event loop captured by start(). Each shape is explained
+    at most once per interval, on a sample of its occurrences.
+    """
+
+    def __init__(self, threshold_ms: float, explain_rate: float, buffer_size: int):
+        self.threshold_ms = threshold_ms
+        self.explain_rate = explain_rate
+        self.recent: deque = deque(maxlen=buffer_size)
+        self.shapes: Dict[tuple, Dict[str, Any]] = {}
+        self.dropped_shapes = 0
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+
+    def stop(self):
+        self._loop = None
+
+    def observe(self, event, collection: str, command: Dict[str, Any], failed: bool):
+        ms = event.duration_micros / 1000
+        if self.threshold_ms <= 0 or ms < self.threshold_ms or event.command_name == "explain":
+            return
+        shape = command_shape(event.command_name, command)
+        shape_key = (event.database_name, collection, event.command_name, json.dumps(shape, sort_keys=True, default=str))
+        route = current_route.get()
+        now = datetime.now(timezone.utc).isoformat()
+        explain = False
+        with self._lock:
+            self.recent.append({
+                "at": now, "ms": round(ms, 1), "collection": collection, "command": event.command_name,
+                "shape": shape, "route": route, "failed": failed
+            })
+            entry = self.shapes.get(shape_key)
+            if entry is None:
+                if len(self.shapes) >= SLOW_QUERY_MAX_SHAPES:
+                    self.dropped_shapes += 1
+                    return
+                entry = self.shapes[shape_key] = {
+                    "collection": collection, "command": event.command_name, "shape": shape,
+                    "count": 0, "total_ms": 0.0, "max_ms": 0.0, "last_seen": None,
+                    "routes": defaultdict(int), "plan": None, "explained_at": 0.0
+                }
+            entry["count"] += 1
+            entry["total_ms"] += ms
+            entry["max_ms"] = max(entry["max_ms"], ms)
+            entry["last_seen"] = now
+            entry["routes"][route] += 1
+            if (
+                event.command_name in EXPLAINABLE_COMMANDS
+                and not failed
+                and self._loop is not None
+                and time.monotonic() - entry["explained_at"] >= SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS
+                and random.random() < self.explain_rate
+            ):
+                entry["explained_at"] = time.monotonic()
+                explain = True
+        logger.warning("Slow query %.0fms %s.%s from %s: %s", ms, collection, event.command_name, route, shape_key[3])
+        if explain:
+            body = {key: value for key, value in command.items() if not key.startswith("$") and key not in EXPLAIN_STRIPPED_FIELDS}
+            asyncio.run_coroutine_threadsafe(self._explain(shape_key, event.database_name, body), self._loop)
+
+    async def _explain(self, shape_key: tuple, database: str, body: Dict[str, Any]):
+        try:
+            result = await client[database].command({"explain": body, "verbosity": "queryPlanner"})
+        except PyMongoError as e:
+            plan = {"error": str(e)}
+        else:
+            plan = plan_summary(result)
+        with self._lock:
+            entry = self.shapes.get(shape_key)
+            if entry is not None:
+                entry["plan"] = plan
+
+    def snapshot(self, limit: int) -> Dict[str, Any]:
+        with self._lock:
+            recent = list(self.recent)[-limit:][::-1]
+            shapes = [
+                {**entry, "total_ms": round(entry["total_ms"], 1), "max_ms": round(entry["max_ms"], 1),
+                 "routes": dict(entry["routes"])}
+                for entry in self.shapes.values()
+            ]
+        for entry in shapes:
+            del entry["explained_at"]
+        shapes.sort(key=lambda entry: entry["total_ms"], reverse=True)
+        return {
+            "threshold_ms": self.threshold_ms,
+            "explain_rate": self.explain_rate,
+            "recent": recent,
+            "shapes": shapes[:limit],
+            "dropped_shapes": self.dropped_shapes
+        }
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_MS, SLOW_QUERY_EXPLAIN_RATE, SLOW_QUERY_BUFFER_SIZE)
+
+def mongo_client_options() -> Dict[str, Any]:
+    """Driver pool and timeout settings from the environment"""
+    options: Dict[str, Any] = {
+        "maxPoolSize": int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+        "minPoolSize": int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+        "maxIdleTimeMS": int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 0)) or None,
+        "waitQueueTimeoutMS": int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 0)) or None,
+        "serverSelectionTimeoutMS": int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000)),
+        "connectTimeoutMS": int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 20000)),
+    }
+    # Only ask for compressors whose libraries are installed; the server
+    # picks the first one it also supports
+    modules = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+    wanted = [c.strip() for c in os.environ.get('MONGO_COMPRESSORS', 'zstd,snappy,zlib').split(",") if c.strip()]
+    compressors = [c for c in wanted if c in modules and importlib.util.find_spec(modules[c])]
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+    return {key: value for key, value in options.items() if value is not None}
+
+# MongoDB connection, opened by the app's lifespan so the client is bound
+# to the loop that serves requests
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+mongo_options = mongo_client_options()
+pool_metrics = PoolMetrics()
+command_metrics = CommandMetrics()
+client: Optional[AsyncIOMotorClient] = None
+db = None
+
+def connect_mongo():
+    global client, db, receipts_fs
+    client = AsyncIOMotorClient(mongo_url, event_listeners=[pool_metrics, command_metrics], **mongo_options)
+    db = client[os.environ['DB_NAME']]
+    receipts_fs = AsyncIOMotorGridFSBucket(db, bucket_name="receipts")
+
+# Receipt images live in GridFS, keyed by the SHA-256 of their content
+receipts_fs: Optional[AsyncIOMotorGridFSBucket] = None
+RECEIPT_MAX_BYTES = int(os.environ.get('RECEIPT_MAX_BYTES', 10 * 1024 * 1024))
+RECEIPT_CHUNK_SIZE = 255 * 1024
+
+# Receipt image normalization
+RECEIPT_MAX_DIMENSION = int(os.environ.get('RECEIPT_MAX_DIMENSION', 1600))
+RECEIPT_THUMB_DIMENSION = int(os.environ.get('RECEIPT_THUMB_DIMENSION', 240))
+RECEIPT_MAX_PIXELS = int(os.environ.get('RECEIPT_MAX_PIXELS', 50_000_000))
+RECEIPT_JPEG_QUALITY = 82
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+
+# Worker processes for admin simulations and reports
+ANALYTICS_WORKERS = int(os.environ.get('ANALYTICS_WORKERS', 1))
 
 # JWT Settings
 JWT_SECRET = os.environ.get('JWT_SECRET', secrets.token_hex(32))
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 168  # 7 days
 
-# Create the main app
-app = FastAPI(title="TSMarket API")
-
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
@@ -158,6 +726,13 @@ class TopUpCodeCreate(BaseModel):
     code: str
     amount: float
 
+class TopUpCodeBulkCreate(BaseModel):
+    count: int
+    amount: float
+    length: int = 12
+    alphabet: str = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # no 0/O or 1/I lookalikes
+    prefix: str = ""
+
 # New TopUp Request model for card-based payments
 class TopUpRequest(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -167,6 +742,8 @@ class TopUpRequest(BaseModel):
     user_email: str
     amount: float
     receipt_url: str  # URL to uploaded receipt image
+    receipt_id: Optional[str] = None  # SHA-256 of the receipt stored in GridFS
+    receipt_thumb_url: Optional[str] = None
     status: str = "pending"  # pending, approved, rejected
     admin_note: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -176,6 +753,11 @@ class TopUpRequestCreate(BaseModel):
     amount: float
     receipt_url: str
 
+class TopUpRequestBulkAction(BaseModel):
+    request_ids: List[str]
+    action: str  # "approve" or "reject"
+    note: str = ""
+
 class AdminSettings(BaseModel):
     model_config = ConfigDict(extra="ignore")
     settings_id: str = "admin_settings"
@@ -267,6 +849,251 @@ def total_xp_for_level(level: int) -> int:
         total += 100 + l * 50
     return total
 
+def level_thresholds(max_xp: int) -> List[int]:
+    """Total XP at which each level starts (index 0 is level 1), as in calculate_level"""
+    thresholds = [0]
+    xp_needed = 100
+    while thresholds[-1] <= max_xp:
+        thresholds.append(thresholds[-1] + xp_needed)
+        xp_needed = 100 + len(thresholds) * 50
+    return thresholds
+
+async def sync_level(user_id: str, xp: int, old_level: int) -> int:
+    """Persist the level for a user's freshly updated XP if it changed"""
+    new_level = calculate_level(xp)
+    if new_level != old_level:
+        # Guarded on xp so a concurrent XP change recomputes its own level
+        await db.users.update_one({"user_id": user_id, "xp": xp}, {"$set": {"level": new_level}})
+    return new_level
+
+def encode_cursor(*values) -> str:
+    """Opaque keyset pagination cursor from the last row's sort key"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str, *types) -> list:
+    """Values of a cursor, which must have one per type given"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if (
+        not isinstance(values, list)
+        or len(values) != len(types)
+        or not all(isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(values, types))
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def parse_iso_param(value: str, name: str) -> datetime:
+    """Parse an ISO date or datetime query parameter, assuming UTC when naive"""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an ISO date")
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def csv_chunk(rows: List[List[Any]]) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+def user_search_fields(name: Optional[str], email: Optional[str]) -> Dict[str, str]:
+    """Lowercased copies of name and email for indexed prefix search"""
+    return {"name_lower": (name or "").lower(), "email_lower": (email or "").lower()}
+
+async def increment_counter(counter_id: str, amount: int = 1):
+    await db.counters.update_one({"counter_id": counter_id}, {"$inc": {"value": amount}}, upsert=True)
+
+async def get_counter(counter_id: str) -> int:
+    counter = await db.counters.find_one({"counter_id": counter_id}, {"_id": 0, "value": 1})
+    return max(counter["value"], 0) if counter else 0
+
+STATS_COUNTER = "admin_stats"
+STATS_FIELDS = ("users_count", "orders_count", "products_count", "total_revenue")
+
+async def increment_stats(**amounts):
+    """Keep the admin dashboard totals current with one $inc per write"""
+    await db.counters.update_one({"counter_id": STATS_COUNTER}, {"$inc": amounts}, upsert=True)
+
+async def load_stats() -> Dict[str, Any]:
+    stats = await db.counters.find_one({"counter_id": STATS_COUNTER}, {"_id": 0, "counter_id": 0}) or {}
+    return {field: max(stats.get(field, 0), 0) for field in STATS_FIELDS}
+
+async def count_stats() -> Dict[str, Any]:
+    totals = await db.orders.aggregate([
+        {"$group": {"_id": None, "orders_count": {"$sum": 1}, "total_revenue": {"$sum": "$total"}}}
+    ]).to_list(1)
+    return {
+        "users_count": await db.users.count_documents({}),
+        "orders_count": totals[0]["orders_count"] if totals else 0,
+        "products_count": await db.products.count_documents({}),
+        "total_revenue": totals[0]["total_revenue"] if totals else 0,
+    }
+
+async def recompute_stats() -> Dict[str, Any]:
+    """Rebuild the stats counter from the collections themselves"""
+    stats = await count_stats()
+    await db.counters.update_one({"counter_id": STATS_COUNTER}, {"$set": stats}, upsert=True)
+    return stats
+
+async def seed_stats():
+    """Create the stats counter if no worker has yet, leaving a live one alone"""
+    if await db.counters.find_one({"counter_id": STATS_COUNTER}, {"_id": 1}) is not None:
+        return
+    stats = await count_stats()
+    # Another worker may have seeded it while we counted; theirs wins
+    await db.counters.update_one({"counter_id": STATS_COUNTER}, {"$setOnInsert": stats}, upsert=True)
+
+class TTLCache:
+    """Caches the result of an async loader for a fixed number of seconds"""
+
+    def __init__(self, name: str, loader, ttl: float):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self._value = None
+        self._expires = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        if time.monotonic() < self._expires:
+            cache_requests.inc((self.name, "hit"))
+            return self._value
+        async with self._lock:
+            if time.monotonic() >= self._expires:
+                cache_requests.inc((self.name, "miss"))
+                self._value = await self.loader()
+                self._expires = time.monotonic() + self.ttl
+            else:
+                cache_requests.inc((self.name, "hit"))
+        return self._value
+
+    def invalidate(self):
+        self._expires = 0.0
+
+class VersionedCache:
+    """Process-local cache of a value derived from a collection.
+
+    Writers call bump() after changing the collection, which moves a version
+    counter in Mongo. Readers re-check that counter at most every
+    check_interval seconds, so changes made through other workers show up
+    within that window, and reload only when it has moved.
+    """
+
+    def __init__(self, name: str, loader, check_interval: float = 1.0):
+        self.name = name
+        self.counter_id = f"{name}_version"
+        self.loader = loader
+        self.check_interval = check_interval
+        self.value = None
+        self.version = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        if self.version is not None and time.monotonic() - self._checked_at < self.check_interval:
+            cache_requests.inc((self.name, "hit"))
+            return self.value
+        async with self._lock:
+            if self.version is not None and time.monotonic() - self._checked_at < self.check_interval:
+                cache_requests.inc((self.name, "hit"))
+                return self.value
+            version = await get_counter(self.counter_id)
+            if version != self.version:
+                cache_requests.inc((self.name, "miss"))
+                self.value = await self.loader()
+                self.version = version
+            else:
+                cache_requests.inc((self.name, "hit"))
+            self._checked_at = time.monotonic()
+            return self.value
+
+    async def bump(self):
+        await increment_counter(self.counter_id)
+        self.version = None
+
+class BufferedWriter:
+    """Queues documents in memory and writes them to a collection in batches.
+
+    A batch is flushed with insert_many once max_batch documents are queued
+    or every flush_interval seconds, whichever comes first. Call close() on
+    shutdown to write out whatever is still buffered. Failed writes are
+    retried, so the collection needs a unique index on the documents' id
+    field for the retries to be idempotent.
+    """
+
+    def __init__(self, collection_name: str, max_batch: int = 500, flush_interval: float = 1.0):
+        self.collection_name = collection_name
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._buffer: List[Dict[str, Any]] = []
+        self._lock = asyncio.Lock()
+        self._ticker: Optional[asyncio.Task] = None
+        self._flushes = set()
+
+    def add(self, doc: Dict[str, Any]):
+        self._buffer.append(doc)
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.create_task(self._tick())
+        if len(self._buffer) >= self.max_batch:
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Shielded so close() can't cancel a batch halfway through its write
+            await asyncio.shield(self.flush())
+
+    async def flush(self):
+        async with self._lock:
+            while self._buffer:
+                docs = self._buffer[:self.max_batch]
+                del self._buffer[:self.max_batch]
+                try:
+                    await db[self.collection_name].insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    # The rest of an unordered batch went in; duplicates are
+                    # rows a previous attempt already wrote
+                    retry = [
+                        docs[err["index"]] for err in e.details.get("writeErrors", [])
+                        if err.get("code") != 11000
+                    ]
+                    if retry:
+                        logger.error("Failed to write %d documents to %s", len(retry), self.collection_name)
+                        if len(self._buffer) < self.max_batch * 10:
+                            self._buffer[:0] = retry
+                        return
+                except PyMongoError:
+                    logger.exception("Failed to flush %d documents to %s", len(docs), self.collection_name)
+                    # Keep them for the next tick unless the buffer is running away
+                    if len(self._buffer) < self.max_batch * 10:
+                        self._buffer[:0] = docs
+                    return
+
+    async def close(self):
+        if self._ticker is not None:
+            self._ticker.cancel()
+        await self.flush()
+
+# Redemption history is written off the request path
+topup_history_writer = BufferedWriter("topup_history")
+audit_writer = BufferedWriter("audit_log")
+
+def audit(admin: User, action: str, target_type: str, target_id: Optional[str] = None, **details):
+    """Record an admin action; it is written with the next audit batch"""
+    audit_writer.add({
+        "audit_id": f"aud_{uuid.uuid4().hex[:12]}",
+        "actor_id": admin.user_id,
+        "actor_email": admin.email,
+        "action": action,
+        "target_type": target_type,
+        "target_id": target_id,
+        "details": details,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
+
 async def get_current_user(request: Request) -> Optional[User]:
     # Try cookie first
     session_token = request.cookies.get("session_token")
@@ -312,6 +1139,1220 @@ async def require_admin(request: Request) -> User:
         raise HTTPException(status_code=403, detail="Admin access required")
     return user
 
+# ==================== RECEIPT STORAGE ====================
+
+RECEIPT_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+RECEIPT_CONTENT_TYPES = {"image/jpeg", "image/png", "image/webp", "image/gif"}
+
+def receipt_url_for(receipt_id: str) -> str:
+    return f"/api/receipts/{receipt_id}"
+
+def decode_receipt_data_url(data_url: str) -> tuple:
+    """Split a base64 data URL into (content_type, bytes)"""
+    header, sep, payload = data_url.partition(",")
+    if not sep or not header.startswith("data:") or not header.endswith(";base64"):
+        raise HTTPException(status_code=400, detail="Invalid receipt image")
+    content_type = header[len("data:"):-len(";base64")].lower()
+    if content_type not in RECEIPT_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail="Unsupported receipt image type")
+    if len(payload) > RECEIPT_MAX_BYTES * 4 // 3 + 4:
+        raise HTTPException(status_code=413, detail="Receipt image too large")
+    try:
+        data = base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid receipt image")
+    if not data:
+        raise HTTPException(status_code=400, detail="Invalid receipt image")
+    return content_type, data
+
+async def store_receipt(data: bytes, content_type: str) -> str:
+    """Store receipt bytes in GridFS once per distinct content, return its id"""
+    receipt_id = hashlib.sha256(data).hexdigest()
+    existing = await db["receipts.files"].find_one({"filename": receipt_id}, {"_id": 1})
+    if not existing:
+        file_id = ObjectId()
+        try:
+            await receipts_fs.upload_from_stream_with_id(
+                file_id,
+                receipt_id,
+                data,
+                chunk_size_bytes=RECEIPT_CHUNK_SIZE,
+                metadata={"content_type": content_type}
+            )
+        except DuplicateKeyError:
+            # A concurrent upload of the same content won the unique filename;
+            # its file serves this receipt too, so drop our orphaned chunks
+            await db["receipts.chunks"].delete_many({"files_id": file_id})
+    return receipt_id
+
+def normalize_receipt_image(data: bytes) -> Dict[str, Any]:
+    """Decode, validate, strip metadata, downscale and recompress a receipt.
+
+    Runs inside the image process pool, so it must stay a plain top-level
+    function. Raises ValueError for anything that is not a usable image.
+    """
+    timings = {}
+    started = time.perf_counter()
+    
+    def mark(stage):
+        nonlocal started
+        now = time.perf_counter()
+        timings[stage] = (now - started) * 1000
+        started = now
+    
+    try:
+        img = Image.open(io.BytesIO(data))
+        # Phone cameras often write MPO: a JPEG with extra frames appended
+        if img.format not in ("JPEG", "MPO", "PNG", "WEBP", "GIF"):
+            raise ValueError("Unsupported receipt image type")
+        # Multi-frame images (MPO, animated GIF/WebP) keep their first frame
+        img.seek(0)
+        width, height = img.size
+        if width * height > RECEIPT_MAX_PIXELS:
+            raise ValueError("Receipt image too large")
+        # Let the JPEG decoder downscale by a power of two while decoding
+        img.draft("RGB", (RECEIPT_MAX_DIMENSION, RECEIPT_MAX_DIMENSION))
+        img.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise ValueError("Invalid receipt image")
+    mark("decode")
+    
+    # Bake in the EXIF orientation, then rebuild the image without any metadata
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        img = Image.new("RGB", rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.getchannel("A"))
+    else:
+        img = img.convert("RGB")
+    mark("strip")
+    
+    img.thumbnail((RECEIPT_MAX_DIMENSION, RECEIPT_MAX_DIMENSION), Image.LANCZOS)
+    mark("downscale")
+    
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=RECEIPT_JPEG_QUALITY, optimize=True, progressive=True)
+    mark("encode")
+    
+    thumb = img.copy()
+    thumb.thumbnail((RECEIPT_THUMB_DIMENSION, RECEIPT_THUMB_DIMENSION), Image.LANCZOS)
+    thumb_out = io.BytesIO()
+    thumb.save(thumb_out, "JPEG", quality=70, optimize=True)
+    mark("thumbnail")
+    
+    return {
+        "image": out.getvalue(),
+        "thumbnail": thumb_out.getvalue(),
+        "width": img.width,
+        "height": img.height,
+        "timings": timings
+    }
+
+def new_process_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawned, not forked: a fork would copy the driver's monitor threads'
+    # locks mid-use and can deadlock the child
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+_image_pool: Optional[ProcessPoolExecutor] = None
+_image_slots: Optional[asyncio.Semaphore] = None
+receipt_pipeline_metrics: Dict[str, Dict[str, float]] = {}
+
+def record_pipeline_timing(stage: str, ms: float):
+    stats = receipt_pipeline_metrics.setdefault(stage, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats["count"] += 1
+    stats["total_ms"] += ms
+    stats["max_ms"] = max(stats["max_ms"], ms)
+
+async def run_receipt_pipeline(data: bytes) -> Dict[str, Any]:
+    """Normalize a receipt in the process pool without blocking the event loop"""
+    global _image_pool, _image_slots
+    if _image_slots is None:
+        # Cap queued jobs too, so a burst of uploads can't pile up raw blobs in memory
+        _image_slots = asyncio.Semaphore(IMAGE_WORKERS * 2)
+    
+    queued = time.perf_counter()
+    async with _image_slots:
+        record_pipeline_timing("queue_wait", (time.perf_counter() - queued) * 1000)
+        started = time.perf_counter()
+        if _image_pool is None:
+            _image_pool = new_process_pool(IMAGE_WORKERS)
+        pool = _image_pool
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(pool, normalize_receipt_image, data)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except BrokenProcessPool:
+            # A worker died; the next upload gets a fresh pool
+            logger.exception("Receipt image pool broke")
+            if _image_pool is pool:
+                _image_pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise HTTPException(status_code=503, detail="Image processing restarted, please retry")
+        record_pipeline_timing("total", (time.perf_counter() - started) * 1000)
+    
+    for stage, ms in result["timings"].items():
+        record_pipeline_timing(stage, ms)
+    return result
+
+async def save_receipt(data_url: str) -> Dict[str, str]:
+    """Normalize an uploaded data URL receipt and store it with its thumbnail"""
+    _, receipt_bytes = decode_receipt_data_url(data_url)
+    result = await run_receipt_pipeline(receipt_bytes)
+    receipt_id = await store_receipt(result["image"], "image/jpeg")
+    thumb_id = await store_receipt(result["thumbnail"], "image/jpeg")
+    return {
+        "receipt_id": receipt_id,
+        "receipt_url": receipt_url_for(receipt_id),
+        "receipt_thumb_url": receipt_url_for(thumb_id)
+    }
+
+def parse_range_header(range_header: str, size: int) -> Optional[tuple]:
+    """Parse a single-range "bytes=" header into inclusive (start, end).
+
+    Returns None when the range cannot be satisfied. Multi-range requests are
+    not supported and fall back to the full body, which RFC 9110 allows.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return (0, size - 1)
+    start_s, sep, end_s = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not start_s:
+            suffix = int(end_s)
+            if suffix <= 0:
+                return None
+            return (max(size - suffix, 0), size - 1)
+        start = int(start_s)
+        end = int(end_s) if end_s else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return None
+    return (start, min(end, size - 1))
+
+# ==================== TOP-UP CODE GUARD ====================
+
+TOPUP_FILTER_CAPACITY = int(os.environ.get('TOPUP_FILTER_CAPACITY', 1_000_000))
+TOPUP_FILTER_ERROR_RATE = 0.001
+TOPUP_FILTER_SYNC_SECONDS = float(os.environ.get('TOPUP_FILTER_SYNC_SECONDS', 1))
+REDEEM_RATE_PER_SECOND = float(os.environ.get('REDEEM_RATE_PER_SECOND', 0.2))
+REDEEM_BURST = int(os.environ.get('REDEEM_BURST', 10))
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings. Never gives false negatives."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+class TopUpCodeFilter:
+    """In-process negative lookup for unused top-up codes.
+
+    A code the filter hasn't seen is rejected without touching Mongo.
+    Workers that create codes bump a version counter, and every worker
+    checks it each sync interval and pulls in codes created since its last
+    sync when it has moved, so a new code is redeemable everywhere within
+    about one interval. Bloom filters can't forget, so redeemed and deleted
+    codes are only counted as stale and the filter is rebuilt once they
+    pile up.
+    """
+
+    # Overlap between syncs to absorb clock skew between workers
+    SYNC_OVERLAP = timedelta(seconds=60)
+    VERSION_COUNTER = "topup_codes_version"
+
+    def __init__(self):
+        self.bloom: Optional[BloomFilter] = None
+        self.stale = 0
+        self.synced_until = ""
+        self.version: Optional[int] = None
+        self._rebuild_adds: Optional[List[str]] = None
+        self._sync_task: Optional[asyncio.Task] = None
+
+    def might_exist(self, code: str) -> bool:
+        # Until the first build completes everything goes to the database
+        if self.bloom is None or code in self.bloom:
+            cache_requests.inc(("topup_code_filter", "miss"))
+            return True
+        # A hit is a lookup the filter answered without a query
+        cache_requests.inc(("topup_code_filter", "hit"))
+        return False
+
+    async def created(self, codes: List[str]):
+        """Add codes just inserted here and tell the other workers to sync"""
+        for code in codes:
+            self.add(code)
+        await increment_counter(self.VERSION_COUNTER)
+
+    def add(self, code: str):
+        if self.bloom is not None:
+            self.bloom.add(code)
+        if self._rebuild_adds is not None:
+            self._rebuild_adds.append(code)
+
+    def mark_stale(self):
+        self.stale += 1
+
+    def _needs_rebuild(self) -> bool:
+        bloom = self.bloom
+        return bloom is not None and (bloom.count > bloom.capacity or self.stale > bloom.capacity // 2)
+
+    async def rebuild(self):
+        self._rebuild_adds = []
+        started = datetime.now(timezone.utc)
+        # Read before the scan, so codes created during it trigger another sync
+        version = await get_counter(self.VERSION_COUNTER)
+        try:
+            live = await db.topup_codes.count_documents({"is_used": False})
+            bloom = BloomFilter(max(TOPUP_FILTER_CAPACITY, live * 2), TOPUP_FILTER_ERROR_RATE)
+            cursor = db.topup_codes.find({"is_used": False}, {"_id": 0, "code": 1}).batch_size(10000)
+            async for doc in cursor:
+                bloom.add(doc["code"])
+            # Codes created here while the scan ran may have been missed by it
+            for code in self._rebuild_adds:
+                bloom.add(code)
+        finally:
+            self._rebuild_adds = None
+        self.bloom = bloom
+        self.stale = 0
+        self.synced_until = (started - self.SYNC_OVERLAP).isoformat()
+        self.version = version
+        logger.info("Top-up code filter built with %d codes", bloom.count)
+
+    async def sync(self):
+        if self._needs_rebuild():
+            await self.rebuild()
+            return
+        version = await get_counter(self.VERSION_COUNTER)
+        if version == self.version:
+            return
+        started = datetime.now(timezone.utc)
+        cursor = db.topup_codes.find(
+            {"created_at": {"$gte": self.synced_until}, "is_used": False},
+            {"_id": 0, "code": 1}
+        )
+        async for doc in cursor:
+            self.add(doc["code"])
+        self.synced_until = (started - self.SYNC_OVERLAP).isoformat()
+        self.version = version
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(TOPUP_FILTER_SYNC_SECONDS)
+            try:
+                await self.sync()
+            except Exception:
+                # Keep syncing, or codes created elsewhere stay unredeemable here
+                logger.exception("Top-up code filter sync failed")
+
+    async def start(self):
+        await self.rebuild()
+        # Startup retries warm-up after a failure, so this may run twice
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync_loop())
+
+    def stop(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+
+class TokenBucketLimiter:
+    """Per-key token buckets refilled at `rate` tokens/second up to `burst`"""
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: Dict[str, tuple] = {}
+
+    def acquire(self, key: str) -> float:
+        """Take a token for key. Returns 0 on success, else seconds to wait."""
+        now = time.monotonic()
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[key] = (tokens - 1, now)
+        if len(self.buckets) > self.max_keys:
+            self._prune(now)
+        return 0.0
+
+    def _prune(self, now: float):
+        # Buckets that have refilled completely carry no state worth keeping
+        self.buckets = {
+            key: (tokens, last) for key, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate < self.burst
+        }
+
+topup_code_filter = TopUpCodeFilter()
+redeem_limiter = TokenBucketLimiter(REDEEM_RATE_PER_SECOND, REDEEM_BURST)
+
+# ==================== WHEEL SAMPLER ====================
+
+class AliasSampler:
+    """Walker/Vose alias table: O(n) to build, O(1) per weighted draw"""
+
+    def __init__(self, weights: List[float], rng: Optional[random.Random] = None):
+        n = len(weights)
+        total = sum(weights)
+        if n == 0 or total <= 0 or any(w < 0 for w in weights):
+            raise ValueError("Weights must be non-negative with a positive sum")
+        
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] += scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Whatever is left is 1.0 up to rounding error and keeps its own column
+        
+        self.n = n
+        self.prob = prob
+        self.alias = alias
+        self.rng = rng or random.Random(secrets.randbits(128))
+        self.prob_array = np.array(prob)
+        self.alias_array = np.array(alias)
+        self.np_rng = np.random.default_rng(self.rng.getrandbits(128))
+
+    def draw(self) -> int:
+        column = self.rng.randrange(self.n)
+        return column if self.rng.random() < self.prob[column] else self.alias[column]
+
+    def draw_many(self, count: int) -> np.ndarray:
+        """Draw count prize indices in one vectorized pass"""
+        columns = self.np_rng.integers(0, self.n, size=count)
+        keep = self.np_rng.random(count) < self.prob_array[columns]
+        return np.where(keep, columns, self.alias_array[columns])
+
+async def load_wheel():
+    """Load the prize set and compile its sampler (None if nothing can be won)"""
+    prizes = await db.wheel_prizes.find({}, {"_id": 0}).to_list(100)
+    weights = [max(p["probability"], 0.0) for p in prizes]
+    sampler = AliasSampler(weights) if sum(weights) > 0 else None
+    return prizes, sampler
+
+wheel_cache = VersionedCache("wheel_prizes", load_wheel)
+WHEEL_MAX_SPINS_PER_CALL = 100
+
+# ==================== PAYOUT SIMULATION ====================
+
+SIMULATION_MAX_SPINS = 50_000_000
+SIMULATION_CHUNK = 1_000_000
+PAYOUT_PERCENTILES = (50, 90, 99, 99.9)
+
+def _weighted_percentiles(values: np.ndarray, counts: np.ndarray) -> Dict[str, float]:
+    order = np.argsort(values)
+    values, cumulative = values[order], np.cumsum(counts[order])
+    return {
+        f"p{q:g}": float(values[np.searchsorted(cumulative, cumulative[-1] * q / 100)])
+        for q in PAYOUT_PERCENTILES
+    }
+
+def simulate_payouts(
+    prizes: List[Dict[str, Any]],
+    rewards: List[Dict[str, Any]],
+    spins: int,
+    users: int,
+    mean_start_xp: float,
+    seed: int
+) -> Dict[str, Any]:
+    """Monte Carlo estimate of coin outflow from wheel spins and level rewards.
+
+    Spins are split evenly over a synthetic population whose starting XP is
+    exponentially distributed around mean_start_xp. XP won on the wheel moves
+    users up the calculate_level curve, unlocking level rewards. Runs in the
+    analytics process pool.
+    """
+    started = time.perf_counter()
+    weights = [max(p["probability"], 0.0) for p in prizes]
+    sampler = AliasSampler(weights, rng=random.Random(seed))
+    coin_values = np.array([p["value"] if p["prize_type"] == "coins" else 0.0 for p in prizes])
+    xp_values = np.array([int(p["value"]) if p["prize_type"] == "xp" else 0 for p in prizes])
+    
+    rng = np.random.default_rng(seed)
+    spins_per_user = spins // users
+    start_xp = rng.exponential(mean_start_xp, users).astype(np.int64) if mean_start_xp > 0 else np.zeros(users, np.int64)
+    user_coins = np.zeros(users)
+    user_xp = np.zeros(users, np.int64)
+    prize_counts = np.zeros(len(prizes), np.int64)
+    
+    # Spins are drawn in blocks of whole users to bound memory
+    block = max(1, SIMULATION_CHUNK // spins_per_user)
+    for first in range(0, users, block):
+        n = min(block, users - first)
+        drawn = sampler.draw_many(n * spins_per_user).reshape(n, spins_per_user)
+        prize_counts += np.bincount(drawn.ravel(), minlength=len(prizes))
+        user_coins[first:first + n] = coin_values[drawn].sum(axis=1)
+        user_xp[first:first + n] = xp_values[drawn].sum(axis=1)
+    
+    end_xp = start_xp + user_xp
+    thresholds = np.array(level_thresholds(int(end_xp.max())))
+    level_before = np.searchsorted(thresholds, start_xp, side="right")
+    level_after = np.searchsorted(thresholds, end_xp, side="right")
+    
+    reward_coins = np.zeros(users)
+    for reward in rewards:
+        if reward["reward_type"] == "coins":
+            unlocked = (level_before < reward["level_required"]) & (level_after >= reward["level_required"])
+            reward_coins += unlocked * reward["value"]
+    levels_gained = int((level_after - level_before).sum())
+    
+    total_spins = spins_per_user * users
+    spin_mean = float(prize_counts @ coin_values / total_spins)
+    spin_var = float(prize_counts @ (coin_values - spin_mean) ** 2 / total_spins)
+    user_total = user_coins + reward_coins
+    
+    return {
+        "spins": total_spins,
+        "users": users,
+        "spins_per_user": spins_per_user,
+        "per_spin": {
+            "expected_coins": spin_mean,
+            "analytic_expected_coins": float(np.dot(weights, coin_values) / sum(weights)),
+            "variance": spin_var,
+            "std": math.sqrt(spin_var),
+            "expected_xp": float(prize_counts @ xp_values / total_spins),
+            **_weighted_percentiles(coin_values, prize_counts)
+        },
+        "per_user": {
+            "expected_coins": float(user_total.mean()),
+            "variance": float(user_total.var()),
+            **{f"p{q:g}": float(np.percentile(user_total, q)) for q in PAYOUT_PERCENTILES}
+        },
+        "level_ups": {
+            "total": levels_gained,
+            "per_1000_spins": levels_gained * 1000 / total_spins,
+            "reward_coins": float(reward_coins.sum()),
+            "reward_coins_per_level_up": float(reward_coins.sum() / levels_gained) if levels_gained else 0.0
+        },
+        "total_coins": float(user_total.sum()),
+        "elapsed_seconds": round(time.perf_counter() - started, 3)
+    }
+
+_analytics_pool: Optional[ProcessPoolExecutor] = None
+
+async def run_in_analytics_pool(fn, *args):
+    """Run CPU-heavy admin work in a worker process, off the event loop"""
+    global _analytics_pool
+    if _analytics_pool is None:
+        _analytics_pool = new_process_pool(ANALYTICS_WORKERS)
+    pool = _analytics_pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # A worker died (often out of memory); the next call gets a fresh pool
+        logger.exception("Analytics pool broke")
+        if _analytics_pool is pool:
+            _analytics_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise HTTPException(status_code=503, detail="Analytics worker restarted, please retry")
+
+# ==================== STATS ROLLUPS ====================
+
+ROLLUP_GRANULARITIES = {"day": 10, "hour": 13}  # prefix length of an ISO timestamp
+ROLLUP_METRICS = ("revenue", "orders", "xp_issued", "topups", "topup_amount", "new_users")
+# XP from wheel spins and level rewards isn't stored per event, so xp_issued
+# can only be counted live and a backfill must leave it alone
+ROLLUP_REBUILDABLE_METRICS = ("revenue", "orders", "topups", "topup_amount", "new_users")
+ROLLUP_MAX_BUCKETS = 2000
+
+def rollup_bucket(timestamp: str, granularity: str) -> str:
+    return timestamp[:ROLLUP_GRANULARITIES[granularity]]
+
+async def record_rollup(timestamp: Optional[str] = None, **amounts):
+    """Add to the day and hour buckets that contain timestamp"""
+    timestamp = timestamp or datetime.now(timezone.utc).isoformat()
+    await db.stats_rollups.bulk_write([
+        UpdateOne(
+            {"granularity": granularity, "bucket": rollup_bucket(timestamp, granularity)},
+            {"$inc": amounts},
+            upsert=True
+        )
+        for granularity in ROLLUP_GRANULARITIES
+    ], ordered=False)
+
+async def _rollup_sums(collection: str, match: Dict[str, Any], time_field: str, granularity: str,
+                       fields: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    group = {"_id": {"$substrCP": [f"${time_field}", 0, ROLLUP_GRANULARITIES[granularity]]}}
+    group.update({name: {"$sum": expr} for name, expr in fields.items()})
+    rows = await db[collection].aggregate([{"$match": match}, {"$group": group}]).to_list(None)
+    return {row.pop("_id"): row for row in rows}
+
+async def backfill_rollups() -> Dict[str, int]:
+    """Rebuild every bucket's rebuildable metrics from the source collections"""
+    written = {}
+    for granularity in ROLLUP_GRANULARITIES:
+        buckets = defaultdict(lambda: dict.fromkeys(ROLLUP_REBUILDABLE_METRICS, 0))
+        sources = [
+            ("orders", {}, "created_at", {"revenue": "$total", "orders": 1}),
+            ("users", {}, "created_at", {"new_users": 1}),
+            ("topup_requests", {"status": "approved"}, "processed_at", {"topups": 1, "topup_amount": "$amount"}),
+            ("topup_history", {}, "created_at", {"topups": 1, "topup_amount": "$amount"}),
+        ]
+        for collection, match, time_field, fields in sources:
+            match = {**match, time_field: {"$type": "string"}}
+            for bucket, sums in (await _rollup_sums(collection, match, time_field, granularity, fields)).items():
+                for name, value in sums.items():
+                    buckets[bucket][name] += value
+        
+        ops = [
+            UpdateOne(
+                {"granularity": granularity, "bucket": bucket},
+                {"$set": metrics, "$setOnInsert": {"xp_issued": 0}},
+                upsert=True
+            )
+            for bucket, metrics in buckets.items()
+        ]
+        for start in range(0, len(ops), 1000):
+            await db.stats_rollups.bulk_write(ops[start:start + 1000], ordered=False)
+        written[granularity] = len(ops)
+    return written
+
+def rollup_bucket_keys(start: datetime, end: datetime, granularity: str) -> List[str]:
+    step = timedelta(days=1) if granularity == "day" else timedelta(hours=1)
+    current = start.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        current = current.replace(hour=0)
+    keys = []
+    while current <= end:
+        keys.append(rollup_bucket(current.isoformat(), granularity))
+        current += step
+    return keys
+
+# ==================== ANALYTICS REPORTS ====================
+
+REPORT_CHUNK_SIZE = int(os.environ.get('REPORT_CHUNK_SIZE', 50_000))
+REPORT_MAX_AGE_SECONDS = float(os.environ.get('REPORT_MAX_AGE_SECONDS', 600))
+REPORT_COHORT_MONTHS = 12
+
+def _read_frames(collection, query: Dict[str, Any], projection: Dict[str, Any], chunk_size: int, to_frames):
+    """Stream a cursor into DataFrames chunk by chunk.
+
+    to_frames turns one chunk of documents into a tuple of frames; the
+    chunks for each position are concatenated at the end, so only one
+    chunk of raw documents is held at a time.
+    """
+    parts = None
+    chunk = []
+    cursor = collection.find(query, projection, batch_size=chunk_size)
+    for doc in cursor:
+        chunk.append(doc)
+        if len(chunk) >= chunk_size:
+            frames = to_frames(chunk)
+            parts = [[f] for f in frames] if parts is None else [p + [f] for p, f in zip(parts, frames)]
+            chunk = []
+    frames = to_frames(chunk)
+    parts = [[f] for f in frames] if parts is None else [p + [f] for p, f in zip(parts, frames)]
+    return [pd.concat(p, ignore_index=True) for p in parts]
+
+def _month(series: pd.Series) -> pd.Series:
+    return pd.to_datetime(series, utc=True, errors="coerce", format="ISO8601").dt.strftime("%Y-%m")
+
+def _user_frames(docs):
+    frame = pd.DataFrame(docs, columns=["user_id", "level", "created_at"])
+    frame["level"] = pd.to_numeric(frame["level"], errors="coerce").fillna(1).astype("int32")
+    frame["cohort"] = _month(frame.pop("created_at"))
+    return (frame,)
+
+def _order_frames(docs):
+    orders = pd.DataFrame(docs, columns=["order_id", "user_id", "total", "created_at"])
+    orders["total"] = pd.to_numeric(orders["total"], errors="coerce").fillna(0.0)
+    orders["month"] = _month(orders.pop("created_at"))
+    items = pd.DataFrame(
+        [
+            (item.get("product_id"), item.get("price", 0) * item.get("quantity", 1))
+            for doc in docs for item in doc.get("items", [])
+        ],
+        columns=["product_id", "revenue"]
+    )
+    return orders, items
+
+def build_analytics_report(mongo_url: str, db_name: str, chunk_size: int) -> Dict[str, Any]:
+    """Compute the admin analytics report; runs in an analytics worker process.
+
+    The worker opens its own synchronous client rather than sharing the
+    server's Motor client, which is bound to the parent's event loop.
+    """
+    started = time.perf_counter()
+    with pymongo.MongoClient(mongo_url) as worker_client:
+        source = worker_client[db_name]
+        (users,) = _read_frames(source.users, {}, {"_id": 0, "user_id": 1, "level": 1, "created_at": 1}, chunk_size, _user_frames)
+        orders, items = _read_frames(
+            source.orders, {}, {"_id": 0, "order_id": 1, "user_id": 1, "total": 1, "created_at": 1, "items": 1},
+            chunk_size, _order_frames
+        )
+        products = pd.DataFrame(
+            list(source.products.find({}, {"_id": 0, "product_id": 1, "category_id": 1})),
+            columns=["product_id", "category_id"]
+        )
+        categories = pd.DataFrame(
+            list(source.categories.find({}, {"_id": 0, "category_id": 1, "name": 1})),
+            columns=["category_id", "name"]
+        )
+    
+    # Average order value, overall and by month
+    monthly = orders.groupby("month")["total"].agg(["count", "sum", "mean"]).tail(REPORT_COHORT_MONTHS)
+    aov = {
+        "overall": float(orders["total"].mean()) if len(orders) else 0.0,
+        "median": float(orders["total"].median()) if len(orders) else 0.0,
+        "by_month": [
+            {"month": month, "orders": int(row["count"]), "revenue": float(row["sum"]), "aov": float(row["mean"])}
+            for month, row in monthly.iterrows()
+        ]
+    }
+    
+    # Cohort retention: share of each signup month's users ordering N months later
+    cohorts = []
+    active = orders[["user_id", "month"]].drop_duplicates().merge(users[["user_id", "cohort"]], on="user_id")
+    active = active.dropna(subset=["month", "cohort"])
+    sizes = users.dropna(subset=["cohort"]).groupby("cohort").size()
+    if len(active):
+        active["offset"] = (
+            pd.PeriodIndex(active["month"], freq="M").astype("int64")
+            - pd.PeriodIndex(active["cohort"], freq="M").astype("int64")
+        )
+        counts = active[active["offset"] >= 0].pivot_table(
+            index="cohort", columns="offset", values="user_id", aggfunc="count", fill_value=0
+        )
+        for cohort in sizes.index[-REPORT_COHORT_MONTHS:]:
+            row = counts.loc[cohort] if cohort in counts.index else pd.Series(dtype="int64")
+            cohorts.append({
+                "cohort": cohort,
+                "users": int(sizes[cohort]),
+                "retention": [round(float(row.get(offset, 0)) / sizes[cohort], 4) for offset in range(int(counts.columns.max()) + 1)]
+            })
+    
+    # Category mix by revenue
+    mix = items.merge(products, on="product_id", how="left").merge(categories, on="category_id", how="left")
+    mix["name"] = mix["name"].fillna("Uncategorized")
+    by_category = mix.groupby("name")["revenue"].sum().sort_values(ascending=False)
+    total_revenue = float(by_category.sum())
+    category_mix = [
+        {"category": name, "revenue": float(revenue), "share": round(float(revenue) / total_revenue, 4) if total_revenue else 0.0}
+        for name, revenue in by_category.items()
+    ]
+    
+    levels = users["level"].value_counts().sort_index()
+    
+    return {
+        "average_order_value": aov,
+        "cohort_retention": cohorts,
+        "category_mix": category_mix,
+        "level_distribution": [{"level": int(level), "users": int(count)} for level, count in levels.items()],
+        "rows": {"users": len(users), "orders": len(orders), "order_items": len(items)},
+        "elapsed_seconds": round(time.perf_counter() - started, 3)
+    }
+
+class AnalyticsReportCache:
+    """Keeps the last report until the data version moves or it ages out.
+
+    The version is the maintained admin stats counter, which changes with
+    every signup, order and product change. Level changes don't move it,
+    so reports are also recomputed after REPORT_MAX_AGE_SECONDS.
+    """
+
+    def __init__(self):
+        self._report: Optional[Dict[str, Any]] = None
+        self._version = None
+        self._computed_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def get(self, refresh: bool = False) -> Dict[str, Any]:
+        version = tuple((await load_stats()).values())
+        async with self._lock:
+            fresh = time.monotonic() - self._computed_at < REPORT_MAX_AGE_SECONDS
+            if refresh or self._report is None or version != self._version or not fresh:
+                cache_requests.inc(("analytics_report", "miss"))
+                report = await run_in_analytics_pool(
+                    build_analytics_report, mongo_url, os.environ['DB_NAME'], REPORT_CHUNK_SIZE
+                )
+                report["generated_at"] = datetime.now(timezone.utc).isoformat()
+                self._report, self._version, self._computed_at = report, version, time.monotonic()
+            else:
+                cache_requests.inc(("analytics_report", "hit"))
+            return self._report
+
+analytics_report_cache = AnalyticsReportCache()
+
+# ==================== LEADERBOARD ====================
+
+LEADERBOARD_SIZE = 100
+LEADERBOARD_PERIODS = ("day", "week", "month")
+LEADERBOARD_RESYNC_SECONDS = float(os.environ.get('LEADERBOARD_RESYNC_SECONDS', 30))
+
+def leaderboard_period_key(period: str, now: Optional[datetime] = None) -> str:
+    now = now or datetime.now(timezone.utc)
+    if period == "day":
+        return now.strftime("%Y-%m-%d")
+    if period == "week":
+        year, week, _ = now.isocalendar()
+        return f"{year}-W{week:02d}"
+    return now.strftime("%Y-%m")
+
+class TopN:
+    """Highest-scoring entries kept sorted by (-xp, user_id).
+
+    Holds a few more than it serves so a user dropping out of the top can be
+    replaced until the next resync fills the gap from the database.
+    """
+
+    def __init__(self, size: int, margin: int = 20):
+        self.size = size
+        self.capacity = size + margin
+        self.keys: List[tuple] = []
+        self.entries: Dict[str, Dict[str, Any]] = {}
+
+    def update(self, entry: Dict[str, Any]):
+        user_id = entry["user_id"]
+        existing = self.entries.pop(user_id, None)
+        if existing is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-existing["xp"], user_id))]
+        key = (-entry["xp"], user_id)
+        if len(self.keys) >= self.capacity and key > self.keys[-1]:
+            return
+        bisect.insort(self.keys, key)
+        self.entries[user_id] = entry
+        if len(self.keys) > self.capacity:
+            _, dropped = self.keys.pop()
+            del self.entries[dropped]
+
+    def remove(self, user_id: str):
+        existing = self.entries.pop(user_id, None)
+        if existing is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-existing["xp"], user_id))]
+
+    def top(self, limit: int) -> List[Dict[str, Any]]:
+        # The board is public, so user_ids (which admin endpoints take) stay internal
+        return [
+            {"rank": rank, "name": self.entries[user_id]["name"], "xp": -neg_xp, "level": self.entries[user_id]["level"]}
+            for rank, (neg_xp, user_id) in enumerate(self.keys[:min(limit, self.size)], start=1)
+        ]
+
+class Leaderboard:
+    """In-memory XP leaderboards, global and per day/week/month.
+
+    Period XP lives in one xp_periods document per user, updated with a
+    single pipeline upsert that resets a period when its key rolls over.
+    Boards are seeded from indexed queries and re-seeded periodically, which
+    also folds in XP earned through other workers.
+    """
+
+    def __init__(self):
+        self.boards: Dict[str, TopN] = {"all": TopN(LEADERBOARD_SIZE)}
+        self.keys: Dict[str, str] = {}
+        self._tasks = set()
+        self._resync_task: Optional[asyncio.Task] = None
+
+    async def seed(self):
+        boards = {"all": TopN(LEADERBOARD_SIZE)}
+        capacity = boards["all"].capacity
+        users = await db.users.find({}, {"_id": 0, "user_id": 1, "name": 1, "xp": 1, "level": 1}).sort(
+            [("xp", -1), ("user_id", 1)]
+        ).limit(capacity).to_list(capacity)
+        for doc in users:
+            boards["all"].update({"user_id": doc["user_id"], "name": doc.get("name"), "xp": doc.get("xp", 0), "level": doc.get("level", 1)})
+        
+        keys = {}
+        for period in LEADERBOARD_PERIODS:
+            keys[period] = key = leaderboard_period_key(period)
+            boards[period] = TopN(LEADERBOARD_SIZE)
+            docs = await db.xp_periods.find(
+                {f"{period}.key": key}, {"_id": 0, "user_id": 1, "name": 1, "level": 1, period: 1}
+            ).sort([(f"{period}.xp", -1), ("user_id", 1)]).limit(capacity).to_list(capacity)
+            for doc in docs:
+                boards[period].update({"user_id": doc["user_id"], "name": doc.get("name"), "xp": doc[period]["xp"], "level": doc.get("level", 1)})
+        self.boards, self.keys = boards, keys
+
+    def get(self, period: str, limit: int) -> List[Dict[str, Any]]:
+        if period != "all" and self.keys.get(period) != leaderboard_period_key(period):
+            # The period rolled over; nobody has XP in the new one until they earn it
+            self.keys[period] = leaderboard_period_key(period)
+            self.boards[period] = TopN(LEADERBOARD_SIZE)
+        return self.boards[period].top(limit)
+
+    def record(self, user_id: str, name: str, xp: int, level: int, gained: int = 0):
+        """Note a user's new XP total; gained XP also counts toward the periods"""
+        self.boards["all"].update({"user_id": user_id, "name": name, "xp": xp, "level": level})
+        if gained > 0:
+            task = asyncio.create_task(self._record_period_xp(user_id, name, level, gained))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def remove(self, user_id: str):
+        for board in self.boards.values():
+            board.remove(user_id)
+
+    async def _record_period_xp(self, user_id: str, name: str, level: int, gained: int):
+        now = datetime.now(timezone.utc)
+        updates = {"name": name, "level": level}
+        for period in LEADERBOARD_PERIODS:
+            key = leaderboard_period_key(period, now)
+            updates[period] = {"$cond": [
+                {"$eq": [f"${period}.key", key]},
+                {"key": key, "xp": {"$add": [f"${period}.xp", gained]}},
+                {"key": key, "xp": gained}
+            ]}
+        try:
+            doc = await db.xp_periods.find_one_and_update(
+                {"user_id": user_id},
+                [{"$set": updates}],
+                upsert=True,
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+        except PyMongoError:
+            logger.exception("Failed to record period XP for %s", user_id)
+            return
+        for period in LEADERBOARD_PERIODS:
+            if self.keys.get(period) == doc[period]["key"]:
+                self.boards[period].update({"user_id": user_id, "name": name, "xp": doc[period]["xp"], "level": level})
+
+    async def _resync_loop(self):
+        while True:
+            await asyncio.sleep(LEADERBOARD_RESYNC_SECONDS)
+            try:
+                await self.seed()
+            except PyMongoError:
+                logger.exception("Leaderboard resync failed")
+
+    async def start(self):
+        await self.seed()
+        # Startup retries warm-up after a failure, so this may run twice
+        if self._resync_task is None:
+            self._resync_task = asyncio.create_task(self._resync_loop())
+
+    def stop(self):
+        if self._resync_task is not None:
+            self._resync_task.cancel()
+
+    async def drain(self, timeout: float):
+        """Stop resyncing and give pending period XP writes until timeout"""
+        self.stop()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+leaderboard = Leaderboard()
+
+# ==================== BACKGROUND JOBS ====================
+
+JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', 500))
+JOB_BATCH_PAUSE_SECONDS = float(os.environ.get('JOB_BATCH_PAUSE_SECONDS', 0.2))
+JOB_LEASE_SECONDS = 60
+JOB_POLL_SECONDS = 30
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+class JobContext:
+    """Handle a job handler uses to report progress and pace itself"""
+
+    def __init__(self, job: Dict[str, Any], owner: str):
+        self.job_id = job["job_id"]
+        self.params = job.get("params", {})
+        self.owner = owner
+
+    async def progress(self, step: str, count: int):
+        """Record work done and renew the lease so no other worker takes over"""
+        await db.jobs.update_one(
+            {"job_id": self.job_id, "owner": self.owner},
+            {
+                "$inc": {f"progress.{step}": count},
+                "$set": {
+                    "step": step,
+                    "updated_at": datetime.now(timezone.utc).isoformat(),
+                    "lease_until": (datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+                }
+            }
+        )
+
+    async def keep_lease(self):
+        """Renew the lease until cancelled, for steps that report no progress for a while"""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                await db.jobs.update_one(
+                    {"job_id": self.job_id, "owner": self.owner},
+                    {"$set": {"lease_until": (datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()}}
+                )
+            except PyMongoError:
+                logger.exception("Failed to renew the lease of job %s", self.job_id)
+
+    async def pause(self):
+        # Yield between batches so foreground requests keep the database
+        await asyncio.sleep(JOB_BATCH_PAUSE_SECONDS)
+
+class JobRunner:
+    """Runs background jobs persisted in the jobs collection.
+
+    A job is claimed with a lease that its handler renews on every batch.
+    Jobs whose worker died are picked up again once the lease lapses, so
+    handlers must be safe to re-run from the start.
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, Any] = {}
+        self.owner = f"worker_{uuid.uuid4().hex[:8]}"
+        self._tasks = set()
+        self._poll_task: Optional[asyncio.Task] = None
+        self._polled: Optional[asyncio.Task] = None
+        self._draining = False
+
+    def register(self, job_type: str):
+        def decorator(fn):
+            self.handlers[job_type] = fn
+            return fn
+        return decorator
+
+    async def enqueue(self, job_type: str, params: Dict[str, Any]) -> str:
+        now = datetime.now(timezone.utc).isoformat()
+        job_id = f"job_{uuid.uuid4().hex[:12]}"
+        await db.jobs.insert_one({
+            "job_id": job_id,
+            "type": job_type,
+            "params": params,
+            "status": "queued",
+            "progress": {},
+            "created_at": now,
+            "updated_at": now
+        })
+        self._spawn(job_id)
+        return job_id
+
+    def _spawn(self, job_id: Optional[str] = None) -> asyncio.Task:
+        task = asyncio.create_task(self._claim_and_run(job_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _claim(self, job_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        now = datetime.now(timezone.utc)
+        query: Dict[str, Any] = {"$or": [
+            {"status": "queued"},
+            {"status": "running", "lease_until": {"$lt": now.isoformat()}}
+        ]}
+        if job_id:
+            query["job_id"] = job_id
+        return await db.jobs.find_one_and_update(
+            query,
+            {"$set": {
+                "status": "running",
+                "owner": self.owner,
+                "started_at": now.isoformat(),
+                "lease_until": (now + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+            }},
+            projection={"_id": 0},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _claim_and_run(self, job_id: Optional[str] = None):
+        try:
+            job = await self._claim(job_id)
+            while job:
+                await self._run(job)
+                if job_id or self._draining:
+                    return
+                job = await self._claim(None)
+        except PyMongoError:
+            logger.exception("Job claim failed")
+
+    async def _run(self, job: Dict[str, Any]):
+        handler = self.handlers.get(job["type"])
+        result, error = None, None
+        try:
+            if handler is None:
+                raise ValueError(f"Unknown job type {job['type']}")
+            result = await handler(JobContext(job, self.owner))
+        except asyncio.CancelledError:
+            # Shutting down; the lease lapses and another worker resumes it
+            raise
+        except Exception as e:
+            logger.exception("Job %s failed", job["job_id"])
+            error = str(e)
+        await db.jobs.update_one(
+            {"job_id": job["job_id"], "owner": self.owner},
+            {"$set": {
+                "status": "failed" if error else "done",
+                "result": result,
+                "error": error,
+                "finished_at": datetime.now(timezone.utc).isoformat(),
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+
+    async def _poll_loop(self):
+        while True:
+            # Polled jobs run as tracked tasks, so drain() waits for them
+            # instead of cancelling them with the poll loop
+            if self._polled is None or self._polled.done():
+                self._polled = self._spawn()
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+    def start(self):
+        self._poll_task = asyncio.create_task(self._poll_loop())
+
+    def stop(self):
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def drain(self, timeout: float):
+        """Let running jobs finish until timeout without claiming new ones.
+
+        Jobs still running at the deadline are cancelled; their lease lapses
+        and another worker resumes them.
+        """
+        self._draining = True
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+        self.stop()
+
+job_runner = JobRunner()
+
+async def delete_in_batches(job: JobContext, collection: str, query: Dict[str, Any], step: str, on_batch=None):
+    """Delete matching documents a batch at a time, reporting progress.
+
+    on_batch(docs, deleted) runs after each delete, so a job re-run after a
+    crash never accounts for documents twice. deleted is below len(docs)
+    only when another run of the job removed some of them first.
+    """
+    while True:
+        docs = await db[collection].find(query).limit(JOB_BATCH_SIZE).to_list(JOB_BATCH_SIZE)
+        if not docs:
+            return
+        result = await db[collection].delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        if on_batch:
+            await on_batch(docs, result.deleted_count)
+        await job.progress(step, result.deleted_count)
+        await job.pause()
+
+async def update_in_batches(job: JobContext, collection: str, query: Dict[str, Any], update: Dict[str, Any], step: str):
+    """Update matching documents a batch at a time; update must take them out of query"""
+    while True:
+        ids = [doc["_id"] for doc in await db[collection].find(query, {"_id": 1}).limit(JOB_BATCH_SIZE).to_list(JOB_BATCH_SIZE)]
+        if not ids:
+            return
+        result = await db[collection].update_many({"_id": {"$in": ids}}, update)
+        await job.progress(step, result.modified_count)
+        await job.pause()
+
+async def release_receipts(receipt_ids: set) -> int:
+    """Delete receipt files no remaining top-up request points to.
+
+    Receipts are stored once per distinct content, so another request may
+    share the same file.
+    """
+    released = 0
+    for receipt_id in receipt_ids:
+        url = receipt_url_for(receipt_id)
+        if await db.topup_requests.find_one(
+            {"$or": [{"receipt_id": receipt_id}, {"receipt_thumb_url": url}]}, {"_id": 1}
+        ):
+            continue
+        async for grid_file in receipts_fs.find({"filename": receipt_id}):
+            try:
+                await receipts_fs.delete(grid_file._id)
+                released += 1
+            except NoFile:
+                pass
+    return released
+
+def topup_request_receipts(docs: List[Dict[str, Any]]) -> set:
+    receipt_ids = set()
+    for doc in docs:
+        if doc.get("receipt_id"):
+            receipt_ids.add(doc["receipt_id"])
+        thumb_url = doc.get("receipt_thumb_url") or ""
+        if thumb_url.startswith("/api/receipts/"):
+            receipt_ids.add(thumb_url.rsplit("/", 1)[1])
+    return receipt_ids
+
+USER_CLEANUP_MODES = ("anonymize", "delete")
+DEFAULT_USER_CLEANUP_MODE = "anonymize"
+
+def fully_deleted(docs: List[Dict[str, Any]], deleted: int, collection: str) -> bool:
+    """Whether a batch's counters should be adjusted for all of its documents"""
+    if 0 < deleted < len(docs):
+        # Another run took part of the batch; we can't tell which part
+        logger.warning("Partial delete of %d/%d %s; recompute stats to correct counters", deleted, len(docs), collection)
+    return deleted == len(docs)
+
+@job_runner.register("user_cleanup")
+async def cleanup_user_data(job: JobContext) -> Dict[str, Any]:
+    """Remove or anonymize everything a deleted user left behind.
+
+    In delete mode orders go too and the stats counters are adjusted; in
+    anonymize mode orders are kept for accounting with the personal fields
+    cleared. Top-up requests and history are always deleted, and receipt
+    files are released once nothing references them.
+    """
+    user_id = job.params["user_id"]
+    mode = job.params.get("mode", DEFAULT_USER_CLEANUP_MODE)
+    
+    if mode == "delete":
+        async def uncount_orders(docs, deleted):
+            if fully_deleted(docs, deleted, "orders"):
+                await increment_stats(orders_count=-deleted, total_revenue=-sum(d.get("total", 0) for d in docs))
+        await delete_in_batches(job, "orders", {"user_id": user_id}, "orders", uncount_orders)
+    else:
+        anonymous_id = f"deleted_{hashlib.sha256(user_id.encode()).hexdigest()[:12]}"
+        await update_in_batches(
+            job, "orders", {"user_id": user_id},
+            {"$set": {"user_id": anonymous_id, "delivery_address": ""}}, "orders"
+        )
+    
+    await delete_in_batches(job, "topup_history", {"user_id": user_id}, "topup_history")
+    
+    receipt_ids = set()
+    async def collect_requests(docs, deleted):
+        receipt_ids.update(topup_request_receipts(docs))
+        pending = sum(1 for d in docs if d.get("status") == "pending")
+        if pending and fully_deleted(docs, deleted, "topup_requests"):
+            await increment_counter(PENDING_TOPUP_COUNTER, -pending)
+    await delete_in_batches(job, "topup_requests", {"user_id": user_id}, "topup_requests", collect_requests)
+    await job.progress("receipts", await release_receipts(receipt_ids))
+    
+    await db.xp_periods.delete_one({"user_id": user_id})
+    return {"user_id": user_id, "mode": mode, "receipts_checked": len(receipt_ids)}
+
+@job_runner.register("rollup_backfill")
+async def rollup_backfill_job(job: JobContext) -> Dict[str, Any]:
+    # Each granularity is one long aggregation with no progress to report,
+    # so the lease is renewed alongside it
+    keepalive = asyncio.create_task(job.keep_lease())
+    try:
+        buckets = await backfill_rollups()
+    finally:
+        keepalive.cancel()
+    for granularity, count in buckets.items():
+        await job.progress(granularity, count)
+    return {"buckets": buckets}
+
 # ==================== AUTH ENDPOINTS ====================
 
 @api_router.post("/auth/register")
@@ -326,6 +2367,7 @@ async def register(data: UserCreate, response: Response):
         "user_id": user_id,
         "email": data.email,
         "name": data.name,
+        **user_search_fields(data.name, data.email),
         "password_hash": hash_password(data.password),
         "picture": None,
         "balance": 0.0,
@@ -338,6 +2380,8 @@ async def register(data: UserCreate, response: Response):
     }
     
     await db.users.insert_one(user_data)
+    await increment_stats(users_count=1)
+    await record_rollup(user_data["created_at"], new_users=1)
     
     # Create session
     session_token = secrets.token_hex(32)
@@ -427,7 +2471,8 @@ async def process_google_session(request: Request, response: Response):
             {"user_id": user_id},
             {"$set": {
                 "name": oauth_data.get("name", existing.get("name")),
-                "picture": oauth_data.get("picture", existing.get("picture"))
+                "picture": oauth_data.get("picture", existing.get("picture")),
+                **user_search_fields(oauth_data.get("name", existing.get("name")), existing["email"])
             }}
         )
     else:
@@ -437,6 +2482,7 @@ async def process_google_session(request: Request, response: Response):
             "user_id": user_id,
             "email": oauth_data["email"],
             "name": oauth_data.get("name", "User"),
+            **user_search_fields(oauth_data.get("name", "User"), oauth_data["email"]),
             "picture": oauth_data.get("picture"),
             "balance": 0.0,
             "xp": 0,
@@ -447,6 +2493,8 @@ async def process_google_session(request: Request, response: Response):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
         await db.users.insert_one(user_data)
+        await increment_stats(users_count=1)
+        await record_rollup(user_data["created_at"], new_users=1)
     
     # Create session
     session_token = oauth_data.get("session_token", secrets.token_hex(32))
@@ -496,6 +2544,7 @@ async def get_categories():
 async def create_category(data: CategoryCreate, user: User = Depends(require_admin)):
     category = Category(**data.model_dump())
     await db.categories.insert_one(category.model_dump())
+    audit(user, "category.create", "category", category.category_id, name=category.name)
     return category
 
 @api_router.delete("/categories/{category_id}")
@@ -503,6 +2552,7 @@ async def delete_category(category_id: str, user: User = Depends(require_admin))
     result = await db.categories.delete_one({"category_id": category_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Category not found")
+    audit(user, "category.delete", "category", category_id)
     return {"message": "Category deleted"}
 
 # ==================== PRODUCT ENDPOINTS ====================
@@ -547,6 +2597,8 @@ async def create_product(data: ProductCreate, user: User = Depends(require_admin
     product_dict = product.model_dump()
     product_dict["created_at"] = product_dict["created_at"].isoformat()
     await db.products.insert_one(product_dict)
+    await increment_stats(products_count=1)
+    audit(user, "product.create", "product", product.product_id, name=product.name, price=product.price)
     return product
 
 @api_router.put("/products/{product_id}", response_model=Product)
@@ -557,6 +2609,7 @@ async def update_product(product_id: str, data: ProductCreate, user: User = Depe
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    audit(user, "product.update", "product", product_id, **data.model_dump())
     
     product = await db.products.find_one({"product_id": product_id}, {"_id": 0})
     return product
@@ -566,6 +2619,8 @@ async def delete_product(product_id: str, user: User = Depends(require_admin)):
     result = await db.products.delete_one({"product_id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await increment_stats(products_count=-1)
+    audit(user, "product.delete", "product", product_id)
     return {"message": "Product deleted"}
 
 # ==================== ORDER ENDPOINTS ====================
@@ -625,6 +2680,8 @@ async def create_order(data: CreateOrderRequest, user: User = Depends(require_us
     order_dict["created_at"] = order_dict["created_at"].isoformat()
     order_dict["items"] = [item.model_dump() for item in order_items]
     await db.orders.insert_one(order_dict)
+    await increment_stats(orders_count=1, total_revenue=total)
+    await record_rollup(order_dict["created_at"], revenue=total, orders=1, xp_issued=total_xp)
     
     # Remove MongoDB _id from response
     order_dict.pop("_id", None)
@@ -647,6 +2704,7 @@ async def create_order(data: CreateOrderRequest, user: User = Depends(require_us
             "wheel_spins_available": new_spins
         }}
     )
+    leaderboard.record(user.user_id, user.name, new_xp, new_level, gained=total_xp)
     
     return {
         "order": order_dict,
@@ -664,35 +2722,55 @@ async def get_user_orders(user: User = Depends(require_user)):
 
 @api_router.post("/topup/redeem")
 async def redeem_topup_code(code: str, user: User = Depends(require_user)):
-    topup = await db.topup_codes.find_one({"code": code, "is_used": False}, {"_id": 0})
-    if not topup:
+    retry_after = redeem_limiter.acquire(user.user_id)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many attempts, try again later",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    if not topup_code_filter.might_exist(code):
         raise HTTPException(status_code=404, detail="Invalid or already used code")
     
-    # Mark as used
-    await db.topup_codes.update_one(
-        {"code": code},
-        {"$set": {"is_used": True, "used_by": user.user_id}}
+    now = datetime.now(timezone.utc).isoformat()
+    
+    # Claim the code; the is_used guard lets exactly one concurrent redemption win
+    topup = await db.topup_codes.find_one_and_update(
+        {"code": code, "is_used": False},
+        {"$set": {"is_used": True, "used_by": user.user_id, "used_at": now}},
+        projection={"_id": 0, "amount": 1}
     )
+    if not topup:
+        raise HTTPException(status_code=404, detail="Invalid or already used code")
+    topup_code_filter.mark_stale()
     
     # Add balance
-    current = await db.users.find_one({"user_id": user.user_id}, {"_id": 0})
-    new_balance = current["balance"] + topup["amount"]
-    
-    await db.users.update_one(
+    current = await db.users.find_one_and_update(
         {"user_id": user.user_id},
-        {"$set": {"balance": new_balance}}
+        {"$inc": {"balance": topup["amount"]}},
+        projection={"_id": 0, "user_id": 1, "balance": 1},
+        return_document=ReturnDocument.AFTER
     )
+    if current is None:
+        # The account was deleted after the claim; give the code back
+        await db.topup_codes.update_one(
+            {"code": code, "used_by": user.user_id},
+            {"$set": {"is_used": False}, "$unset": {"used_by": "", "used_at": ""}}
+        )
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    await record_rollup(now, topups=1, topup_amount=topup["amount"])
     
     # Log history
-    await db.topup_history.insert_one({
+    topup_history_writer.add({
         "history_id": f"hist_{uuid.uuid4().hex[:12]}",
         "user_id": user.user_id,
         "code": code,
         "amount": topup["amount"],
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": now
     })
     
-    return {"message": "Balance topped up", "amount": topup["amount"], "new_balance": new_balance}
+    return {"message": "Balance topped up", "amount": topup["amount"], "new_balance": current["balance"]}
 
 # New card-based top-up system
 @api_router.get("/topup/settings")
@@ -710,19 +2788,24 @@ async def get_topup_settings():
 @api_router.post("/topup/request")
 async def create_topup_request(data: TopUpRequestCreate, user: User = Depends(require_user)):
     """Create a new top-up request with receipt"""
+    receipt = {"receipt_id": None, "receipt_url": data.receipt_url, "receipt_thumb_url": None}
+    if data.receipt_url.startswith("data:"):
+        receipt = await save_receipt(data.receipt_url)
+    
     request_data = {
         "request_id": f"req_{uuid.uuid4().hex[:12]}",
         "user_id": user.user_id,
         "user_name": user.name,
         "user_email": user.email,
         "amount": data.amount,
-        "receipt_url": data.receipt_url,
+        **receipt,
         "status": "pending",
         "admin_note": None,
         "created_at": datetime.now(timezone.utc).isoformat(),
         "processed_at": None
     }
     await db.topup_requests.insert_one(request_data)
+    await increment_counter(PENDING_TOPUP_COUNTER)
     request_data.pop("_id", None)
     return request_data
 
@@ -732,6 +2815,62 @@ async def get_user_topup_requests(user: User = Depends(require_user)):
     requests = await db.topup_requests.find({"user_id": user.user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
     return requests
 
+@api_router.get("/receipts/{receipt_id}")
+async def download_receipt(receipt_id: str, request: Request, user: User = Depends(require_user)):
+    """Stream a stored receipt image to its owner or an admin, with Range and caching support"""
+    if not RECEIPT_ID_RE.match(receipt_id):
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    if not user.is_admin:
+        # Receipts are shared by content, so any of the user's requests may point here
+        owned = await db.topup_requests.find_one(
+            {"user_id": user.user_id, "$or": [{"receipt_id": receipt_id}, {"receipt_thumb_url": receipt_url_for(receipt_id)}]},
+            {"_id": 1}
+        )
+        if owned is None:
+            raise HTTPException(status_code=404, detail="Receipt not found")
+    try:
+        grid_out = await receipts_fs.open_download_stream_by_name(receipt_id)
+    except NoFile:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    
+    # Content-addressed ids never change, so the id itself is a strong ETag
+    etag = f'"{receipt_id}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes"
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    size = grid_out.length
+    start, end = 0, size - 1
+    status_code = 200
+    range_header = request.headers.get("range")
+    if range_header and size > 0:
+        byte_range = parse_range_header(range_header, size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        if byte_range != (0, size - 1):
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    grid_out.seek(start)
+    
+    async def body():
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.read(min(RECEIPT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    
+    content_type = (grid_out.metadata or {}).get("content_type", "application/octet-stream")
+    return StreamingResponse(body(), status_code=status_code, headers=headers, media_type=content_type)
+
 @api_router.get("/topup/history")
 async def get_topup_history(user: User = Depends(require_user)):
     history = await db.topup_history.find({"user_id": user.user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
@@ -739,9 +2878,47 @@ async def get_topup_history(user: User = Depends(require_user)):
 
 # ==================== REWARDS ENDPOINTS ====================
 
+async def load_rewards() -> Dict[int, List[Dict[str, Any]]]:
+    """Rewards grouped by level, in level order; a level's rewards are claimed together"""
+    rewards = await db.rewards.find({}, {"_id": 0}).sort("level_required", 1).to_list(1000)
+    table: Dict[int, List[Dict[str, Any]]] = {}
+    for reward in rewards:
+        table.setdefault(reward["level_required"], []).append(reward)
+    return table
+
+reward_cache = VersionedCache("rewards", load_rewards)
+
+def reward_increments(rewards: List[Dict[str, Any]]) -> Dict[str, Any]:
+    inc = {}
+    for reward in rewards:
+        if reward["reward_type"] == "coins":
+            inc["balance"] = inc.get("balance", 0) + reward["value"]
+        elif reward["reward_type"] == "xp_boost":
+            inc["xp"] = inc.get("xp", 0) + int(reward["value"])
+    return inc
+
+async def apply_rewards(user: User, rewards: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Claim rewards in one guarded update; None if the guard no longer holds"""
+    levels = [r["level_required"] for r in rewards]
+    update: Dict[str, Any] = {"$addToSet": {"claimed_rewards": {"$each": levels}}}
+    inc = reward_increments(rewards)
+    if inc:
+        update["$inc"] = inc
+    current = await db.users.find_one_and_update(
+        {"user_id": user.user_id, "level": {"$gte": max(levels)}, "claimed_rewards": {"$nin": levels}},
+        update,
+        projection={"_id": 0, "xp": 1, "level": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if current and "xp" in inc:
+        current["level"] = await sync_level(user.user_id, current["xp"], current["level"])
+        leaderboard.record(user.user_id, user.name, current["xp"], current["level"], gained=inc["xp"])
+        await record_rollup(xp_issued=inc["xp"])
+    return current
+
 @api_router.get("/rewards")
 async def get_rewards(user: User = Depends(require_user)):
-    rewards = await db.rewards.find({}, {"_id": 0}).sort("level_required", 1).to_list(100)
+    rewards = [dict(reward) for level_rewards in (await reward_cache.get()).values() for reward in level_rewards]
     
     # Mark which rewards user can claim
     for reward in rewards:
@@ -755,8 +2932,8 @@ async def get_rewards(user: User = Depends(require_user)):
 
 @api_router.post("/rewards/claim/{level}")
 async def claim_reward(level: int, user: User = Depends(require_user)):
-    reward = await db.rewards.find_one({"level_required": level}, {"_id": 0})
-    if not reward:
+    rewards = (await reward_cache.get()).get(level)
+    if not rewards:
         raise HTTPException(status_code=404, detail="Reward not found")
     
     if user.level < level:
@@ -765,18 +2942,34 @@ async def claim_reward(level: int, user: User = Depends(require_user)):
     if level in user.claimed_rewards:
         raise HTTPException(status_code=400, detail="Reward already claimed")
     
-    # Apply reward
-    current = await db.users.find_one({"user_id": user.user_id}, {"_id": 0})
-    updates = {"claimed_rewards": current["claimed_rewards"] + [level]}
-    
-    if reward["reward_type"] == "coins":
-        updates["balance"] = current["balance"] + reward["value"]
-    elif reward["reward_type"] == "xp_boost":
-        updates["xp"] = current["xp"] + int(reward["value"])
+    # The update's guard decides concurrent claims of the same reward
+    if not await apply_rewards(user, rewards):
+        raise HTTPException(status_code=400, detail="Reward already claimed")
     
-    await db.users.update_one({"user_id": user.user_id}, {"$set": updates})
+    return {"message": "Reward claimed", "reward": rewards[0], "rewards": rewards}
+
+@api_router.post("/rewards/claim-all")
+async def claim_all_rewards(user: User = Depends(require_user)):
+    """Claim every reward the user is eligible for in a single update"""
+    table = await reward_cache.get()
+    level, claimed = user.level, user.claimed_rewards
+    for _ in range(3):
+        eligible = [r for lvl, rewards in table.items() if lvl <= level and lvl not in claimed for r in rewards]
+        if not eligible:
+            break
+        if await apply_rewards(user, eligible):
+            return {
+                "message": "Rewards claimed",
+                "rewards": eligible,
+                "totals": reward_increments(eligible)
+            }
+        # Lost a race with another claim; re-read and try with what's left
+        current = await db.users.find_one({"user_id": user.user_id}, {"_id": 0, "user_id": 1, "level": 1, "claimed_rewards": 1})
+        if current is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        level, claimed = current["level"], current.get("claimed_rewards", [])
     
-    return {"message": "Reward claimed", "reward": reward}
+    raise HTTPException(status_code=400, detail="No rewards to claim")
 
 # ==================== WHEEL ENDPOINTS ====================
 
@@ -786,88 +2979,379 @@ async def get_wheel_prizes():
     return prizes
 
 @api_router.post("/wheel/spin")
-async def spin_wheel(user: User = Depends(require_user)):
+async def spin_wheel(count: int = Query(1, ge=1, le=WHEEL_MAX_SPINS_PER_CALL), user: User = Depends(require_user)):
     if user.wheel_spins_available <= 0:
         raise HTTPException(status_code=400, detail="No spins available")
+    if user.wheel_spins_available < count:
+        raise HTTPException(status_code=400, detail="Not enough spins available")
     
-    prizes = await db.wheel_prizes.find({}, {"_id": 0}).to_list(100)
-    if not prizes:
+    prizes, sampler = await wheel_cache.get()
+    if sampler is None:
         raise HTTPException(status_code=404, detail="No prizes configured")
     
-    # Weighted random selection
-    total_prob = sum(p["probability"] for p in prizes)
-    rand = random.uniform(0, total_prob)
-    cumulative = 0
-    selected_prize = prizes[0]
-    
-    for prize in prizes:
-        cumulative += prize["probability"]
-        if rand <= cumulative:
-            selected_prize = prize
-            break
-    
-    # Apply prize
-    current = await db.users.find_one({"user_id": user.user_id}, {"_id": 0})
-    updates = {"wheel_spins_available": current["wheel_spins_available"] - 1}
+    selected = [prizes[i] for i in (sampler.draw_many(count) if count > 1 else [sampler.draw()])]
+    coins = sum(p["value"] for p in selected if p["prize_type"] == "coins")
+    xp = sum(int(p["value"]) for p in selected if p["prize_type"] == "xp")
     
-    if selected_prize["prize_type"] == "coins":
-        updates["balance"] = current["balance"] + selected_prize["value"]
-    elif selected_prize["prize_type"] == "xp":
-        new_xp = current["xp"] + int(selected_prize["value"])
-        new_level = calculate_level(new_xp)
-        updates["xp"] = new_xp
-        updates["level"] = new_level
+    # Reserve the spins and apply every prize in one guarded update
+    current = await db.users.find_one_and_update(
+        {"user_id": user.user_id, "wheel_spins_available": {"$gte": count}},
+        {"$inc": {"wheel_spins_available": -count, "balance": coins, "xp": xp}},
+        projection={"_id": 0, "wheel_spins_available": 1, "xp": 1, "level": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not current:
+        raise HTTPException(status_code=400, detail="Not enough spins available")
     
-    await db.users.update_one({"user_id": user.user_id}, {"$set": updates})
+    old_level = current["level"]
+    new_level = await sync_level(user.user_id, current["xp"], old_level)
+    if xp:
+        leaderboard.record(user.user_id, user.name, current["xp"], new_level, gained=xp)
+        await record_rollup(xp_issued=xp)
     
-    return {"prize": selected_prize, "spins_remaining": current["wheel_spins_available"] - 1}
+    return {
+        "prize": selected[0],
+        "prizes": selected,
+        "coins_won": coins,
+        "xp_won": xp,
+        "new_level": new_level,
+        "level_up": new_level > old_level,
+        "spins_remaining": current["wheel_spins_available"]
+    }
+
+# ==================== LEADERBOARD ENDPOINTS ====================
+
+@api_router.get("/leaderboard")
+async def get_leaderboard(
+    period: str = "all",
+    limit: int = Query(LEADERBOARD_SIZE, ge=1, le=LEADERBOARD_SIZE)
+):
+    """Top players by XP, served from memory"""
+    if period != "all" and period not in LEADERBOARD_PERIODS:
+        raise HTTPException(status_code=400, detail="Invalid period")
+    return {"period": period, "entries": leaderboard.get(period, limit)}
+
+@api_router.get("/leaderboard/me")
+async def get_my_rank(period: str = "all", user: User = Depends(require_user)):
+    """The current user's rank, counted on the xp index with the board's user_id tie-break"""
+    if period == "all":
+        xp = user.xp
+        ahead = await db.users.count_documents({"$or": [
+            {"xp": {"$gt": xp}},
+            {"xp": xp, "user_id": {"$lt": user.user_id}}
+        ]})
+    elif period in LEADERBOARD_PERIODS:
+        key = leaderboard_period_key(period)
+        doc = await db.xp_periods.find_one({"user_id": user.user_id, f"{period}.key": key}, {"_id": 0, period: 1})
+        xp = doc[period]["xp"] if doc else 0
+        if not xp:
+            return {"period": period, "rank": None, "xp": 0}
+        ahead = await db.xp_periods.count_documents({f"{period}.key": key, "$or": [
+            {f"{period}.xp": {"$gt": xp}},
+            {f"{period}.xp": xp, "user_id": {"$lt": user.user_id}}
+        ]})
+    else:
+        raise HTTPException(status_code=400, detail="Invalid period")
+    return {"period": period, "rank": ahead + 1, "xp": xp}
 
 # ==================== ADMIN ENDPOINTS ====================
 
+ADMIN_STATS_TTL_SECONDS = float(os.environ.get('ADMIN_STATS_TTL_SECONDS', 5))
+admin_stats_cache = TTLCache("admin_stats", load_stats, ADMIN_STATS_TTL_SECONDS)
+
 @api_router.get("/admin/stats")
 async def get_admin_stats(user: User = Depends(require_admin)):
-    users_count = await db.users.count_documents({})
-    orders_count = await db.orders.count_documents({})
-    products_count = await db.products.count_documents({})
+    """Dashboard totals read from the maintained stats counter"""
+    return await admin_stats_cache.get()
+
+@api_router.post("/admin/stats/recompute")
+async def recompute_admin_stats(user: User = Depends(require_admin)):
+    """Recount the dashboard totals from the collections"""
+    stats = await recompute_stats()
+    admin_stats_cache.invalidate()
+    audit(user, "stats.recompute", "stats", STATS_COUNTER)
+    return stats
+
+@api_router.get("/admin/stats/timeseries")
+async def get_stats_timeseries(
+    start: str,
+    end: str,
+    granularity: str = "day",
+    user: User = Depends(require_admin)
+):
+    """Bucketed revenue, orders, XP, top-ups and signups for a date range"""
+    if granularity not in ROLLUP_GRANULARITIES:
+        raise HTTPException(status_code=400, detail="Granularity must be day or hour")
+    start_at = parse_iso_param(start, "start")
+    end_at = parse_iso_param(end, "end")
+    if end_at < start_at:
+        raise HTTPException(status_code=400, detail="end is before start")
+    step = timedelta(days=1) if granularity == "day" else timedelta(hours=1)
+    if (end_at - start_at) / step >= ROLLUP_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail="Range too large for this granularity")
+    
+    keys = rollup_bucket_keys(start_at.astimezone(timezone.utc), end_at.astimezone(timezone.utc), granularity)
+    docs = await db.stats_rollups.find(
+        {"granularity": granularity, "bucket": {"$gte": keys[0], "$lte": keys[-1]}},
+        {"_id": 0, "granularity": 0}
+    ).to_list(len(keys))
+    found = {doc.pop("bucket"): doc for doc in docs}
+    
+    buckets = []
+    totals = dict.fromkeys(ROLLUP_METRICS, 0)
+    for key in keys:
+        metrics = {name: found.get(key, {}).get(name, 0) for name in ROLLUP_METRICS}
+        for name, value in metrics.items():
+            totals[name] += value
+        buckets.append({"bucket": key, **metrics})
+    return {"granularity": granularity, "buckets": buckets, "totals": totals}
+
+@api_router.post("/admin/stats/rollups/backfill")
+async def start_rollup_backfill(user: User = Depends(require_admin)):
+    """Rebuild all rollup buckets from the source collections as a background job"""
+    if await db.jobs.find_one({"type": "rollup_backfill", "status": {"$in": ["queued", "running"]}}, {"_id": 1}):
+        raise HTTPException(status_code=409, detail="Backfill already running")
+    job_id = await job_runner.enqueue("rollup_backfill", {})
+    audit(user, "stats.backfill", "job", job_id)
+    return {"message": "Backfill started", "job_id": job_id}
+
+# Sort field -> value stored for users created without it, so keyset paging
+# never meets a missing key
+USER_SORT_FIELDS = {"created_at": "1970-01-01T00:00:00+00:00", "balance": 0.0, "xp": 0}
+USER_LIST_PROJECTION = {"_id": 0, "password_hash": 0, "name_lower": 0, "email_lower": 0}
+USER_EXPORT_FIELDS = ["user_id", "email", "name", "balance", "xp", "level", "is_admin", "wheel_spins_available", "created_at"]
+
+def user_directory_query(q: Optional[str], sort: str, order: str):
+    if sort not in USER_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail="Invalid sort field")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="Order must be asc or desc")
+    query: Dict[str, Any] = {}
+    if q:
+        # Anchored, case-sensitive regexes on the lowercased copies stay on the index
+        prefix = "^" + re.escape(q.strip().lower())
+        query["$or"] = [{"email_lower": {"$regex": prefix}}, {"name_lower": {"$regex": prefix}}]
+    direction = 1 if order == "asc" else -1
+    return query, [(sort, direction), ("user_id", direction)]
+
+@api_router.get("/admin/users")
+async def get_all_users(
+    q: Optional[str] = None,
+    sort: str = "created_at",
+    order: str = "desc",
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    user: User = Depends(require_admin)
+):
+    """Search users by email or name prefix and page through them with a keyset cursor"""
+    query, sort_spec = user_directory_query(q, sort, order)
+    if cursor:
+        value_type = str if isinstance(USER_SORT_FIELDS[sort], str) else (int, float)
+        value, user_id = decode_cursor(cursor, value_type, str)
+        op = "$gt" if order == "asc" else "$lt"
+        keyset = {"$or": [{sort: {op: value}}, {sort: value, "user_id": {op: user_id}}]}
+        query = {"$and": [query, keyset]} if query else keyset
     
-    # Total revenue
-    orders = await db.orders.find({}, {"total": 1, "_id": 0}).to_list(10000)
-    total_revenue = sum(o.get("total", 0) for o in orders)
+    items = await db.users.find(query, USER_LIST_PROJECTION).sort(sort_spec).limit(limit + 1).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].get(sort), items[-1]["user_id"])
     
     return {
-        "users_count": users_count,
-        "orders_count": orders_count,
-        "products_count": products_count,
-        "total_revenue": total_revenue
+        "items": items,
+        "next_cursor": next_cursor,
+        "total": None if q else (await admin_stats_cache.get())["users_count"]
     }
 
-@api_router.get("/admin/users")
-async def get_all_users(user: User = Depends(require_admin)):
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
-    return users
+@api_router.get("/admin/users/export")
+async def export_users(
+    format: str = "csv",
+    q: Optional[str] = None,
+    sort: str = "created_at",
+    order: str = "desc",
+    user: User = Depends(require_admin)
+):
+    """Stream the user directory as CSV or NDJSON without loading it into memory"""
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Format must be csv or ndjson")
+    query, sort_spec = user_directory_query(q, sort, order)
+    projection = {"_id": 0, **dict.fromkeys(USER_EXPORT_FIELDS, 1)}
+    
+    def export_chunk(rows):
+        if format == "csv":
+            return csv_chunk([[doc.get(field) for field in USER_EXPORT_FIELDS] for doc in rows])
+        return "".join(json.dumps(doc) + "\n" for doc in rows)
+    
+    async def generate():
+        if format == "csv":
+            yield csv_chunk([USER_EXPORT_FIELDS])
+        rows = []
+        async for doc in db.users.find(query, projection).sort(sort_spec).batch_size(1000):
+            rows.append(doc)
+            if len(rows) == 1000:
+                yield export_chunk(rows)
+                rows = []
+        if rows:
+            yield export_chunk(rows)
+    
+    filename = f"users_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.{format}"
+    return StreamingResponse(
+        generate(),
+        media_type="text/csv" if format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 @api_router.put("/admin/users/{user_id}/admin")
 async def toggle_admin(user_id: str, is_admin: bool, user: User = Depends(require_admin)):
-    result = await db.users.update_one(
+    previous = await db.users.find_one_and_update(
         {"user_id": user_id},
-        {"$set": {"is_admin": is_admin}}
+        {"$set": {"is_admin": is_admin}},
+        projection={"_id": 0, "user_id": 1, "is_admin": 1}
     )
-    if result.matched_count == 0:
+    if previous is None:
         raise HTTPException(status_code=404, detail="User not found")
+    audit(user, "user.set_admin", "user", user_id, before=previous.get("is_admin", False), after=is_admin)
     return {"message": "Admin status updated"}
 
 @api_router.post("/admin/topup-codes", response_model=TopUpCode)
 async def create_topup_code(data: TopUpCodeCreate, user: User = Depends(require_admin)):
-    existing = await db.topup_codes.find_one({"code": data.code}, {"_id": 0})
-    if existing:
-        raise HTTPException(status_code=400, detail="Code already exists")
-    
     code = TopUpCode(**data.model_dump())
     code_dict = code.model_dump()
     code_dict["created_at"] = code_dict["created_at"].isoformat()
-    await db.topup_codes.insert_one(code_dict)
+    # The unique index on code rejects duplicates without a pre-check
+    try:
+        await db.topup_codes.insert_one(code_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Code already exists")
+    await topup_code_filter.created([code.code])
+    audit(user, "topup_code.create", "topup_code", code.code_id, amount=code.amount)
     return code
 
+TOPUP_CODE_BULK_MAX = 500_000
+TOPUP_CODE_BATCH_SIZE = 1000
+_system_random = random.SystemRandom()
+
+def validate_code_batch(data: TopUpCodeBulkCreate) -> str:
+    """Check a bulk request and return its alphabet with duplicates removed"""
+    alphabet = "".join(dict.fromkeys(data.alphabet))
+    if not 1 <= data.count <= TOPUP_CODE_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"Count must be between 1 and {TOPUP_CODE_BULK_MAX}")
+    if data.amount <= 0:
+        raise HTTPException(status_code=400, detail="Amount must be positive")
+    if not 6 <= data.length <= 32:
+        raise HTTPException(status_code=400, detail="Length must be between 6 and 32")
+    if len(alphabet) < 2 or any(c.isspace() or c == "," for c in alphabet):
+        raise HTTPException(status_code=400, detail="Invalid alphabet")
+    # Keep codes sparse in their space so guessing stays hopeless and collisions rare
+    if len(alphabet) ** data.length < data.count * 10**6:
+        raise HTTPException(status_code=400, detail="Alphabet and length give too few possible codes")
+    return alphabet
+
+@job_runner.register("topup_code_batch")
+async def generate_topup_code_batch(job: JobContext) -> Dict[str, Any]:
+    """Insert a batch's codes, topping up to its count when re-run after a crash.
+
+    If an insert fails for anything but a collision, the codes inserted so
+    far are deleted so no live code exists that nobody can download.
+    """
+    params = job.params
+    batch_id = params["batch_id"]
+    remaining = params["count"] - await db.topup_codes.count_documents({"batch_id": batch_id})
+    
+    def new_code_doc(created_at: str) -> Dict[str, Any]:
+        return {
+            "code_id": f"code_{uuid.uuid4().hex[:12]}",
+            "code": params["prefix"] + "".join(_system_random.choices(params["alphabet"], k=params["length"])),
+            "amount": params["amount"],
+            "batch_id": batch_id,
+            "is_used": False,
+            "created_at": created_at
+        }
+    
+    while remaining > 0:
+        created_at = datetime.now(timezone.utc).isoformat()
+        batch = [new_code_doc(created_at) for _ in range(min(TOPUP_CODE_BATCH_SIZE, remaining))]
+        while batch:
+            retry = 0
+            try:
+                await db.topup_codes.insert_many(batch, ordered=False)
+                inserted = batch
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                if any(err.get("code") != 11000 for err in errors):
+                    deleted = await db.topup_codes.delete_many({"batch_id": batch_id})
+                    for _ in range(deleted.deleted_count):
+                        topup_code_filter.mark_stale()
+                    raise RuntimeError(f"Code generation failed: {errors[0].get('errmsg')}")
+                # Collisions are resolved by the unique index; regenerate just those
+                failed = {err["index"] for err in errors}
+                inserted = [doc for i, doc in enumerate(batch) if i not in failed]
+                retry = len(failed)
+            remaining -= len(inserted)
+            if inserted:
+                await topup_code_filter.created([doc["code"] for doc in inserted])
+                await job.progress("codes", len(inserted))
+            batch = [new_code_doc(created_at) for _ in range(retry)]
+        await job.pause()
+    return {"batch_id": batch_id, "count": params["count"]}
+
+@api_router.post("/admin/topup-codes/bulk")
+async def bulk_create_topup_codes(data: TopUpCodeBulkCreate, user: User = Depends(require_admin)):
+    """Queue generation of a batch of random codes.
+
+    The codes are all stored under batch_id before any are handed out;
+    download them from /admin/topup-codes/batches/{batch_id}/export once
+    the job is done.
+    """
+    alphabet = validate_code_batch(data)
+    batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+    job_id = await job_runner.enqueue("topup_code_batch", {
+        "batch_id": batch_id,
+        "count": data.count,
+        "amount": data.amount,
+        "length": data.length,
+        "alphabet": alphabet,
+        "prefix": data.prefix
+    })
+    audit(user, "topup_code.bulk_create", "topup_code_batch", batch_id, count=data.count, amount=data.amount, prefix=data.prefix, job_id=job_id)
+    return {"batch_id": batch_id, "job_id": job_id}
+
+@api_router.get("/admin/topup-codes/batches/{batch_id}/export")
+async def export_topup_code_batch(batch_id: str, user: User = Depends(require_admin)):
+    """Stream a finished batch's codes as CSV; can be downloaded again if interrupted"""
+    job = await db.jobs.find_one(
+        {"type": "topup_code_batch", "params.batch_id": batch_id},
+        {"_id": 0, "status": 1, "error": 1}
+    )
+    if job is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    if job["status"] == "failed":
+        raise HTTPException(status_code=500, detail=f"Batch generation failed: {job.get('error')}")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Batch is still {job['status']}")
+    
+    async def generate():
+        yield csv_chunk([["code", "amount"]])
+        cursor = db.topup_codes.find(
+            {"batch_id": batch_id}, {"_id": 0, "code": 1, "amount": 1}
+        ).sort("code", 1).batch_size(TOPUP_CODE_BATCH_SIZE)
+        rows = []
+        async for doc in cursor:
+            rows.append([doc["code"], doc["amount"]])
+            if len(rows) >= TOPUP_CODE_BATCH_SIZE:
+                yield csv_chunk(rows)
+                rows = []
+        if rows:
+            yield csv_chunk(rows)
+    
+    return StreamingResponse(
+        generate(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="topup_codes_{batch_id}.csv"'}
+    )
+
 @api_router.get("/admin/topup-codes")
 async def get_topup_codes(user: User = Depends(require_admin)):
     codes = await db.topup_codes.find({}, {"_id": 0}).to_list(1000)
@@ -875,9 +3359,12 @@ async def get_topup_codes(user: User = Depends(require_admin)):
 
 @api_router.delete("/admin/topup-codes/{code_id}")
 async def delete_topup_code(code_id: str, user: User = Depends(require_admin)):
-    result = await db.topup_codes.delete_one({"code_id": code_id})
-    if result.deleted_count == 0:
+    deleted = await db.topup_codes.find_one_and_delete({"code_id": code_id}, projection={"_id": 0, "is_used": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Code not found")
+    if not deleted.get("is_used"):
+        topup_code_filter.mark_stale()
+    audit(user, "topup_code.delete", "topup_code", code_id)
     return {"message": "Code deleted"}
 
 # Admin settings for card payments
@@ -900,96 +3387,330 @@ async def update_admin_settings(data: AdminSettingsUpdate, user: User = Depends(
         }},
         upsert=True
     )
+    audit(user, "settings.update", "settings", "admin_settings", card_holder=data.card_holder)
     return {"message": "Settings updated"}
 
 # Top-up requests management
+TOPUP_REQUEST_STATUSES = ("pending", "approved", "rejected")
+PENDING_TOPUP_COUNTER = "topup_requests_pending"
+
+# Listing projection: never ship legacy inline base64 receipts to the admin list
+TOPUP_REQUEST_LIST_PROJECTION = {
+    "_id": 0,
+    "request_id": 1,
+    "user_id": 1,
+    "user_name": 1,
+    "user_email": 1,
+    "amount": 1,
+    "status": 1,
+    "admin_note": 1,
+    "created_at": 1,
+    "processed_at": 1,
+    "receipt_id": 1,
+    "receipt_thumb_url": 1,
+    "receipt_url": {"$cond": [
+        {"$eq": [{"$substrBytes": [{"$ifNull": ["$receipt_url", ""]}, 0, 5]}, "data:"]},
+        None,
+        "$receipt_url"
+    ]}
+}
+
 @api_router.get("/admin/topup-requests")
-async def get_all_topup_requests(user: User = Depends(require_admin)):
-    requests = await db.topup_requests.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return requests
+async def get_all_topup_requests(
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    user: User = Depends(require_admin)
+):
+    """Page through top-up requests, newest first, optionally by status"""
+    query: Dict[str, Any] = {}
+    if status:
+        if status not in TOPUP_REQUEST_STATUSES:
+            raise HTTPException(status_code=400, detail="Invalid status")
+        query["status"] = status
+    if cursor:
+        created_at, request_id = decode_cursor(cursor, str, str)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "request_id": {"$lt": request_id}}
+        ]
+    
+    items = await db.topup_requests.find(query, TOPUP_REQUEST_LIST_PROJECTION).sort(
+        [("created_at", -1), ("request_id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1]["created_at"], items[-1]["request_id"])
+    
+    return {
+        "items": items,
+        "next_cursor": next_cursor,
+        "pending_count": await get_counter(PENDING_TOPUP_COUNTER)
+    }
 
-@api_router.put("/admin/topup-requests/{request_id}/approve")
-async def approve_topup_request(request_id: str, user: User = Depends(require_admin)):
-    req = await db.topup_requests.find_one({"request_id": request_id}, {"_id": 0})
+async def transition_topup_request(request_id: str, updates: Dict[str, Any]) -> Dict[str, Any]:
+    """Move a request out of pending exactly once, or raise if it can't be"""
+    updates["processed_at"] = datetime.now(timezone.utc).isoformat()
+    req = await db.topup_requests.find_one_and_update(
+        {"request_id": request_id, "status": "pending"},
+        {"$set": updates},
+        projection={"_id": 0, "user_id": 1, "amount": 1}
+    )
     if not req:
+        if await db.topup_requests.find_one({"request_id": request_id}, {"_id": 1}):
+            raise HTTPException(status_code=400, detail="Request already processed")
         raise HTTPException(status_code=404, detail="Request not found")
     
-    if req["status"] != "pending":
-        raise HTTPException(status_code=400, detail="Request already processed")
-    
-    # Update request status
-    await db.topup_requests.update_one(
-        {"request_id": request_id},
-        {"$set": {
-            "status": "approved",
-            "processed_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+    await increment_counter(PENDING_TOPUP_COUNTER, -1)
+    return req
+
+@api_router.put("/admin/topup-requests/{request_id}/approve")
+async def approve_topup_request(request_id: str, user: User = Depends(require_admin)):
+    req = await transition_topup_request(request_id, {"status": "approved"})
     
     # Add balance to user
-    target_user = await db.users.find_one({"user_id": req["user_id"]}, {"_id": 0})
-    if target_user:
-        new_balance = target_user["balance"] + req["amount"]
-        await db.users.update_one(
-            {"user_id": req["user_id"]},
-            {"$set": {"balance": new_balance}}
-        )
+    await db.users.update_one(
+        {"user_id": req["user_id"]},
+        {"$inc": {"balance": req["amount"]}}
+    )
+    await record_rollup(topups=1, topup_amount=req["amount"])
+    audit(user, "topup_request.approve", "topup_request", request_id, user_id=req["user_id"], amount=req["amount"])
     
     return {"message": "Request approved", "amount": req["amount"]}
 
 @api_router.put("/admin/topup-requests/{request_id}/reject")
 async def reject_topup_request(request_id: str, note: str = "", user: User = Depends(require_admin)):
-    req = await db.topup_requests.find_one({"request_id": request_id}, {"_id": 0})
-    if not req:
-        raise HTTPException(status_code=404, detail="Request not found")
+    req = await transition_topup_request(request_id, {"status": "rejected", "admin_note": note})
+    audit(user, "topup_request.reject", "topup_request", request_id, user_id=req["user_id"], note=note)
+    return {"message": "Request rejected"}
+
+@api_router.post("/admin/migrations/receipts")
+async def migrate_inline_receipts(user: User = Depends(require_admin)):
+    """Move base64 receipts stored inline in topup_requests into GridFS"""
+    migrated = 0
+    failed = []
+    # Small batches keep only a handful of blobs in memory at a time
+    cursor = db.topup_requests.find(
+        {"receipt_url": {"$regex": "^data:"}},
+        {"_id": 1, "request_id": 1, "receipt_url": 1}
+    ).batch_size(10)
+    async for req in cursor:
+        try:
+            receipt = await save_receipt(req["receipt_url"])
+        except HTTPException as e:
+            failed.append({"request_id": req.get("request_id"), "error": e.detail})
+            continue
+        await db.topup_requests.update_one({"_id": req["_id"]}, {"$set": receipt})
+        migrated += 1
+    
+    audit(user, "receipts.migrate", "topup_request", None, migrated=migrated, failed=len(failed))
+    return {"message": "Receipts migrated", "migrated": migrated, "failed": failed}
+
+@api_router.get("/admin/receipts/pipeline-metrics")
+async def get_receipt_pipeline_metrics(user: User = Depends(require_admin)):
+    """Per-stage timings of the receipt normalization pipeline in this worker"""
+    return {
+        stage: {
+            "count": stats["count"],
+            "avg_ms": round(stats["total_ms"] / stats["count"], 2),
+            "max_ms": round(stats["max_ms"], 2)
+        }
+        for stage, stats in receipt_pipeline_metrics.items()
+    }
+
+@api_router.post("/admin/topup-requests/bulk")
+async def bulk_process_topup_requests(data: TopUpRequestBulkAction, user: User = Depends(require_admin)):
+    """Approve or reject many pending requests with a constant number of round trips"""
+    if data.action not in ("approve", "reject"):
+        raise HTTPException(status_code=400, detail="Action must be approve or reject")
+    request_ids = list(dict.fromkeys(data.request_ids))
+    if not request_ids:
+        raise HTTPException(status_code=400, detail="No requests given")
+    if len(request_ids) > 1000:
+        raise HTTPException(status_code=400, detail="Too many requests in one batch")
     
-    if req["status"] != "pending":
-        raise HTTPException(status_code=400, detail="Request already processed")
+    status = "approved" if data.action == "approve" else "rejected"
+    batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+    updates = {
+        "status": status,
+        "processed_at": datetime.now(timezone.utc).isoformat(),
+        "batch_id": batch_id
+    }
+    if data.action == "reject":
+        updates["admin_note"] = data.note
     
-    await db.topup_requests.update_one(
-        {"request_id": request_id},
-        {"$set": {
-            "status": "rejected",
-            "admin_note": note,
-            "processed_at": datetime.now(timezone.utc).isoformat()
-        }}
+    # The status guard makes each transition atomic; a request can leave
+    # pending only once, so batch_id marks exactly the ones this call moved
+    await db.topup_requests.update_many(
+        {"request_id": {"$in": request_ids}, "status": "pending"},
+        {"$set": updates}
     )
+    docs = await db.topup_requests.find(
+        {"request_id": {"$in": request_ids}},
+        {"_id": 0, "request_id": 1, "user_id": 1, "amount": 1, "batch_id": 1}
+    ).to_list(len(request_ids))
+    found = {d["request_id"]: d for d in docs}
+    transitioned = [d for d in docs if d.get("batch_id") == batch_id]
     
-    return {"message": "Request rejected"}
+    if transitioned:
+        await increment_counter(PENDING_TOPUP_COUNTER, -len(transitioned))
+    
+    if data.action == "approve" and transitioned:
+        credits = defaultdict(float)
+        for req in transitioned:
+            credits[req["user_id"]] += req["amount"]
+        await db.users.bulk_write(
+            [UpdateOne({"user_id": user_id}, {"$inc": {"balance": amount}}) for user_id, amount in credits.items()],
+            ordered=False
+        )
+        await record_rollup(
+            updates["processed_at"],
+            topups=len(transitioned),
+            topup_amount=sum(credits.values())
+        )
+    
+    results = []
+    for request_id in request_ids:
+        req = found.get(request_id)
+        if not req:
+            results.append({"request_id": request_id, "result": "not_found"})
+        elif req.get("batch_id") != batch_id:
+            results.append({"request_id": request_id, "result": "already_processed"})
+        else:
+            results.append({"request_id": request_id, "result": status, "amount": req["amount"]})
+    
+    audit(
+        user, f"topup_request.bulk_{data.action}", "topup_request", batch_id,
+        request_ids=[req["request_id"] for req in transitioned],
+        amount=sum(req["amount"] for req in transitioned)
+    )
+    return {"message": f"{len(transitioned)} requests {status}", "processed": len(transitioned), "results": results}
 
 # Delete user
 @api_router.delete("/admin/users/{user_id}")
-async def delete_user(user_id: str, user: User = Depends(require_admin)):
+async def delete_user(user_id: str, mode: str = DEFAULT_USER_CLEANUP_MODE, user: User = Depends(require_admin)):
+    """Delete the account now and clean up its data in a background job"""
     if user_id == user.user_id:
         raise HTTPException(status_code=400, detail="Cannot delete yourself")
+    if mode not in USER_CLEANUP_MODES:
+        raise HTTPException(status_code=400, detail="Mode must be delete or anonymize")
     result = await db.users.delete_one({"user_id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await increment_stats(users_count=-1)
+    leaderboard.remove(user_id)
     # Also delete user sessions
     await db.user_sessions.delete_many({"user_id": user_id})
-    return {"message": "User deleted"}
+    job_id = await job_runner.enqueue("user_cleanup", {"user_id": user_id, "mode": mode})
+    audit(user, "user.delete", "user", user_id, mode=mode, cleanup_job_id=job_id)
+    return {"message": "User deleted", "cleanup_job_id": job_id}
+
+@api_router.get("/admin/audit-log")
+async def get_audit_log(
+    actor_id: Optional[str] = None,
+    action: Optional[str] = None,
+    target_type: Optional[str] = None,
+    target_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    user: User = Depends(require_admin)
+):
+    """Page through admin actions, newest first.
+
+    Events are written in batches, so the last second of actions may not
+    show up yet.
+    """
+    query: Dict[str, Any] = {}
+    if actor_id:
+        query["actor_id"] = actor_id
+    if action:
+        query["action"] = action
+    if target_type:
+        query["target_type"] = target_type
+    if target_id:
+        query["target_id"] = target_id
+    if cursor:
+        created_at, audit_id = decode_cursor(cursor, str, str)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "audit_id": {"$lt": audit_id}}
+        ]
+    
+    items = await db.audit_log.find(query, {"_id": 0}).sort(
+        [("created_at", -1), ("audit_id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1]["created_at"], items[-1]["audit_id"])
+    return {"items": items, "next_cursor": next_cursor}
+
+@api_router.get("/admin/db/pool-metrics")
+async def get_pool_metrics(user: User = Depends(require_admin)):
+    """Pool settings and usage for this worker, plus per-command latency"""
+    return {
+        "worker_pid": os.getpid(),
+        "options": mongo_options,
+        "pool": pool_metrics.snapshot(),
+        "commands": command_metrics.snapshot()
+    }
+
+@api_router.get("/admin/db/slow-queries")
+async def get_slow_queries(limit: int = Query(50, ge=1, le=500), user: User = Depends(require_admin)):
+    """Recent slow commands and their aggregate per query shape, slowest total first"""
+    return {"worker_pid": os.getpid(), **slow_query_log.snapshot(limit)}
+
+@api_router.get("/admin/jobs")
+async def get_jobs(
+    status: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    user: User = Depends(require_admin)
+):
+    """Recent background jobs, newest first"""
+    query: Dict[str, Any] = {}
+    if status:
+        if status not in JOB_STATUSES:
+            raise HTTPException(status_code=400, detail="Invalid status")
+        query["status"] = status
+    return await db.jobs.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+
+@api_router.get("/admin/jobs/{job_id}")
+async def get_job(job_id: str, user: User = Depends(require_admin)):
+    job = await db.jobs.find_one({"job_id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 # Update user balance (admin)
 @api_router.put("/admin/users/{user_id}/balance")
 async def update_user_balance(user_id: str, balance: float, user: User = Depends(require_admin)):
-    result = await db.users.update_one(
+    previous = await db.users.find_one_and_update(
         {"user_id": user_id},
-        {"$set": {"balance": balance}}
+        {"$set": {"balance": balance}},
+        projection={"_id": 0, "balance": 1}
     )
-    if result.matched_count == 0:
+    if previous is None:
         raise HTTPException(status_code=404, detail="User not found")
+    audit(user, "user.set_balance", "user", user_id, before=previous.get("balance"), after=balance)
     return {"message": "Balance updated"}
 
 # Update user XP/Level (admin)
 @api_router.put("/admin/users/{user_id}/xp")
 async def update_user_xp(user_id: str, xp: int, user: User = Depends(require_admin)):
     new_level = calculate_level(xp)
-    result = await db.users.update_one(
+    target = await db.users.find_one_and_update(
         {"user_id": user_id},
-        {"$set": {"xp": xp, "level": new_level}}
+        {"$set": {"xp": xp, "level": new_level}},
+        projection={"_id": 0, "name": 1, "xp": 1}
     )
-    if result.matched_count == 0:
+    if target is None:
         raise HTTPException(status_code=404, detail="User not found")
+    audit(user, "user.set_xp", "user", user_id, before=target.get("xp"), after=xp)
+    # Admin corrections move the all-time board but aren't XP earned this period
+    leaderboard.record(user_id, target.get("name"), xp, new_level)
     return {"message": "XP updated", "new_level": new_level}
 
 # Admin profile update (email/password)
@@ -1017,11 +3738,16 @@ async def update_admin_profile(data: AdminProfileUpdate, user: User = Depends(re
     if data.name:
         updates["name"] = data.name
     
+    if data.email or data.name:
+        updates.update(user_search_fields(data.name or user.name, updates.get("email", user.email)))
+    
     if updates:
         await db.users.update_one(
             {"user_id": user.user_id},
             {"$set": updates}
         )
+        # Field names only; the password hash never goes into the log
+        audit(user, "admin.update_profile", "user", user.user_id, fields=sorted(updates))
     
     return {"message": "Profile updated"}
 
@@ -1029,6 +3755,8 @@ async def update_admin_profile(data: AdminProfileUpdate, user: User = Depends(re
 async def create_reward(data: RewardCreate, user: User = Depends(require_admin)):
     reward = Reward(**data.model_dump())
     await db.rewards.insert_one(reward.model_dump())
+    await reward_cache.bump()
+    audit(user, "reward.create", "reward", reward.reward_id, level_required=reward.level_required, value=reward.value)
     return reward
 
 @api_router.delete("/admin/rewards/{reward_id}")
@@ -1036,12 +3764,16 @@ async def delete_reward(reward_id: str, user: User = Depends(require_admin)):
     result = await db.rewards.delete_one({"reward_id": reward_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Reward not found")
+    await reward_cache.bump()
+    audit(user, "reward.delete", "reward", reward_id)
     return {"message": "Reward deleted"}
 
 @api_router.post("/admin/wheel-prizes", response_model=WheelPrize)
 async def create_wheel_prize(data: WheelPrizeCreate, user: User = Depends(require_admin)):
     prize = WheelPrize(**data.model_dump())
     await db.wheel_prizes.insert_one(prize.model_dump())
+    await wheel_cache.bump()
+    audit(user, "wheel_prize.create", "wheel_prize", prize.prize_id, value=prize.value, probability=prize.probability)
     return prize
 
 @api_router.delete("/admin/wheel-prizes/{prize_id}")
@@ -1049,13 +3781,129 @@ async def delete_wheel_prize(prize_id: str, user: User = Depends(require_admin))
     result = await db.wheel_prizes.delete_one({"prize_id": prize_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Prize not found")
+    await wheel_cache.bump()
+    audit(user, "wheel_prize.delete", "wheel_prize", prize_id)
     return {"message": "Prize deleted"}
 
+@api_router.post("/admin/simulations/payout")
+async def simulate_payout(
+    spins: int = Query(10_000_000, ge=1000, le=SIMULATION_MAX_SPINS),
+    users: int = Query(10_000, ge=1, le=1_000_000),
+    mean_start_xp: Optional[float] = Query(None, ge=0),
+    seed: Optional[int] = Query(None, ge=0),
+    user: User = Depends(require_admin)
+):
+    """Simulate expected coin outflow for the current wheel and reward setup"""
+    if users > spins:
+        raise HTTPException(status_code=400, detail="Need at least one spin per user")
+    prizes, sampler = await wheel_cache.get()
+    if sampler is None:
+        raise HTTPException(status_code=404, detail="No prizes configured")
+    rewards = [reward for level_rewards in (await reward_cache.get()).values() for reward in level_rewards]
+    
+    if mean_start_xp is None:
+        # Default the synthetic population to the real average XP
+        avg = await db.users.aggregate([{"$group": {"_id": None, "xp": {"$avg": "$xp"}}}]).to_list(1)
+        mean_start_xp = (avg[0]["xp"] or 0) if avg else 0
+    
+    return await run_in_analytics_pool(
+        simulate_payouts, prizes, rewards, spins, users, mean_start_xp,
+        seed if seed is not None else secrets.randbits(64)
+    )
+
+@api_router.get("/admin/reports/analytics")
+async def get_analytics_report(refresh: bool = False, user: User = Depends(require_admin)):
+    """Cohort retention, order value, category mix and level distribution"""
+    return await analytics_report_cache.get(refresh)
+
 @api_router.get("/admin/orders")
 async def get_all_orders(user: User = Depends(require_admin)):
     orders = await db.orders.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
     return orders
 
+ORDER_EXPORT_FIELDS = ["order_id", "created_at", "user_id", "status", "total", "total_xp", "item_count", "items", "delivery_address"]
+ORDER_EXPORT_BATCH = 500
+
+@api_router.get("/admin/orders/export")
+async def export_orders(
+    format: str = "ndjson",
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    status: Optional[str] = None,
+    after: Optional[str] = None,
+    user: User = Depends(require_admin)
+):
+    """Stream orders oldest first as NDJSON or CSV.
+
+    start is inclusive and end exclusive. An interrupted export resumes by
+    passing the last order_id received as after.
+    """
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Format must be csv or ndjson")
+    created: Dict[str, Any] = {}
+    if start:
+        created["$gte"] = parse_iso_param(start, "start").astimezone(timezone.utc).isoformat()
+    if end:
+        created["$lt"] = parse_iso_param(end, "end").astimezone(timezone.utc).isoformat()
+    query: Dict[str, Any] = {}
+    if created:
+        query["created_at"] = created
+    if status:
+        query["status"] = status
+    if after:
+        last = await db.orders.find_one({"order_id": after}, {"_id": 0, "created_at": 1})
+        if not last:
+            raise HTTPException(status_code=400, detail="Unknown order in after")
+        keyset = {"$or": [
+            {"created_at": {"$gt": last["created_at"]}},
+            {"created_at": last["created_at"], "order_id": {"$gt": after}}
+        ]}
+        query = {"$and": [query, keyset]} if query else keyset
+    
+    def export_row(order: Dict[str, Any]) -> Dict[str, Any]:
+        items = order.get("items", [])
+        return {
+            "order_id": order["order_id"],
+            "created_at": order.get("created_at"),
+            "user_id": order.get("user_id"),
+            "status": order.get("status"),
+            "total": order.get("total"),
+            "total_xp": order.get("total_xp"),
+            "item_count": sum(item.get("quantity", 1) for item in items),
+            "items": items,
+            "delivery_address": order.get("delivery_address", "")
+        }
+    
+    def export_chunk(rows: List[Dict[str, Any]]) -> str:
+        if format == "csv":
+            return csv_chunk([
+                [json.dumps(row["items"]) if field == "items" else row[field] for field in ORDER_EXPORT_FIELDS]
+                for row in rows
+            ])
+        return "".join(json.dumps(row) + "\n" for row in rows)
+    
+    async def generate():
+        # Each yield waits for the client to take the chunk before the
+        # cursor fetches more, so memory stays at one batch
+        if format == "csv":
+            yield csv_chunk([ORDER_EXPORT_FIELDS])
+        rows = []
+        cursor = db.orders.find(query, {"_id": 0}).sort([("created_at", 1), ("order_id", 1)]).batch_size(ORDER_EXPORT_BATCH)
+        async for order in cursor:
+            rows.append(export_row(order))
+            if len(rows) == ORDER_EXPORT_BATCH:
+                yield export_chunk(rows)
+                rows = []
+        if rows:
+            yield export_chunk(rows)
+    
+    filename = f"orders_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.{format}"
+    return StreamingResponse(
+        generate(),
+        media_type="text/csv" if format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 # ==================== SEED DATA ====================
 
 @api_router.post("/seed")
@@ -1128,6 +3976,7 @@ async def seed_database():
         },
     ]
     await db.products.insert_many(products)
+    await increment_stats(products_count=len(products))
     
     # Rewards
     rewards = [
@@ -1138,6 +3987,7 @@ async def seed_database():
         {"reward_id": "rew_005", "level_required": 20, "name": "Dragon Master", "description": "1000 coins exclusive reward!", "reward_type": "coins", "value": 1000, "is_exclusive": True},
     ]
     await db.rewards.insert_many(rewards)
+    await reward_cache.bump()
     
     # Wheel Prizes
     wheel_prizes = [
@@ -1149,6 +3999,7 @@ async def seed_database():
         {"prize_id": "prize_006", "name": "200 Coins JACKPOT!", "prize_type": "coins", "value": 200, "probability": 0.05, "color": "#FFD700"},
     ]
     await db.wheel_prizes.insert_many(wheel_prizes)
+    await wheel_cache.bump()
     
     # Demo top-up codes
     topup_codes = [
@@ -1157,12 +4008,14 @@ async def seed_database():
         {"code_id": "code_003", "code": "GAMING1000", "amount": 1000, "is_used": False, "created_at": datetime.now(timezone.utc).isoformat()},
     ]
     await db.topup_codes.insert_many(topup_codes)
+    await topup_code_filter.created([topup_code["code"] for topup_code in topup_codes])
     
     # Create admin user
     admin_user = {
         "user_id": "user_admin001",
         "email": "admin@tsmarket.com",
         "name": "Admin",
+        **user_search_fields("Admin", "admin@tsmarket.com"),
         "password_hash": hash_password("admin123"),
         "picture": None,
         "balance": 10000.0,
@@ -1174,25 +4027,715 @@ async def seed_database():
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.users.insert_one(admin_user)
+    await increment_stats(users_count=1)
+    await record_rollup(admin_user["created_at"], new_users=1)
     
     return {"message": "Database seeded successfully"}
 
-# Include router
-app.include_router(api_router)
+# ==================== REQUEST PROFILER ====================
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_BUFFER_SIZE = int(os.environ.get('PROFILE_BUFFER_SIZE', 50))
+PROFILE_INTERVAL_SECONDS = float(os.environ.get('PROFILE_INTERVAL_SECONDS', 0.001))
+
+class RequestProfile:
+    """Stack samples and Mongo timings for one request.
 
-# CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["https://summary-ai-2.preview.emergentagent.com", "http://localhost:3000"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+    A sampler thread snapshots the event loop thread's stack every
+    PROFILE_INTERVAL_SECONDS. Samples are whatever the loop was running,
+    so other requests served concurrently show up too; samples taken while
+    the loop sat in select() are time spent awaiting I/O.
+    """
+
+    def __init__(self, method: str, path: str):
+        self.profile_id = f"prof_{uuid.uuid4().hex[:12]}"
+        self.method = method
+        self.path = path
+        self.route = None
+        self.status = None
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.stacks: Dict[str, int] = defaultdict(int)
+        self.samples = 0
+        self.mongo: Dict[tuple, List[float]] = defaultdict(lambda: [0, 0.0])
+        self.wall_ms = 0.0
+        self.cpu_ms = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def record_mongo(self, collection: str, command: str, ms: float):
+        with self._lock:
+            stats = self.mongo[(collection, command)]
+            stats[0] += 1
+            stats[1] += ms
+
+    def _sample(self, thread_id: int):
+        while not self._stop.wait(PROFILE_INTERVAL_SECONDS):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._cpu_started = time.process_time()
+        self._wall_started = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample, args=(threading.get_ident(),), daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        self.wall_ms = (time.perf_counter() - self._wall_started) * 1000
+        self.cpu_ms = (time.process_time() - self._cpu_started) * 1000
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            mongo = [
+                {"collection": collection, "command": command, "count": count, "ms": round(ms, 3)}
+                for (collection, command), (count, ms) in sorted(self.mongo.items(), key=lambda item: -item[1][1])
+            ]
+        return {
+            "profile_id": self.profile_id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "started_at": self.started_at,
+            "wall_ms": round(self.wall_ms, 3),
+            "cpu_ms": round(self.cpu_ms, 3),
+            "mongo_ms": round(sum(item["ms"] for item in mongo), 3),
+            "samples": self.samples,
+            "mongo": mongo,
+        }
+
+    def collapsed(self) -> str:
+        """Stacks in the collapsed format flamegraph.pl and speedscope read"""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+recent_profiles: deque = deque(maxlen=PROFILE_BUFFER_SIZE)
+
+class ProfilerMiddleware:
+    """Profiles a sampled request, or one carrying X-Profile: PROFILE_TOKEN.
+
+    Only one request is profiled at a time per worker so samples from two
+    profiles never mix.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._active = False
+
+    def _wanted(self, scope) -> bool:
+        if self._active:
+            return False
+        if PROFILE_TOKEN:
+            for name, value in scope["headers"]:
+                if name == b"x-profile":
+                    # Raw bytes: decoding can fail, and compare_digest rejects non-ASCII str
+                    return secrets.compare_digest(value, PROFILE_TOKEN.encode())
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+        profile = RequestProfile(scope["method"], scope["path"])
+        
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message.setdefault("headers", []).append((b"x-profile-id", profile.profile_id.encode()))
+            await send(message)
+        
+        self._active = True
+        token = current_profile.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.stop()
+            current_profile.reset(token)
+            self._active = False
+            route = scope.get("route")
+            profile.route = getattr(route, "path", None)
+            recent_profiles.append(profile)
+
+@api_router.get("/admin/profiles")
+async def get_profiles(user: User = Depends(require_admin)):
+    """Summaries of the most recent profiled requests on this worker, newest first"""
+    return [profile.summary() for profile in reversed(recent_profiles)]
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, format: str = "json", user: User = Depends(require_admin)):
+    """One profile as JSON, or as collapsed stacks for a flamegraph"""
+    for profile in list(recent_profiles):
+        if profile.profile_id == profile_id:
+            if format == "collapsed":
+                return PlainTextResponse(profile.collapsed())
+            return {**profile.summary(), "stacks": dict(profile.stacks)}
+    raise HTTPException(status_code=404, detail="Profile not found")
+
+# ==================== MEMORY PROFILER ====================
+
+MEMORY_PROFILING = os.environ.get('MEMORY_PROFILING', '').lower() in ('1', 'true', 'yes')
+MEMORY_TRACE_FRAMES = int(os.environ.get('MEMORY_TRACE_FRAMES', 1))
+# Allocations made by tracemalloc, the source lookups for its reports and
+# the import machinery are noise in a diff
+MEMORY_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, linecache.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
 )
 
+class MemoryProfiler:
+    """Per-route allocation deltas and snapshot diffs from tracemalloc.
+
+    Tracing is off unless MEMORY_PROFILING is set or an admin turns it on;
+    while off the middleware does nothing but check is_tracing().
+    """
+
+    def __init__(self):
+        self.routes: Dict[str, Dict[str, Any]] = {}
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.baseline_at: Optional[str] = None
+
+    def start(self, frames: int = MEMORY_TRACE_FRAMES):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        # Snapshots from an earlier tracing session don't diff meaningfully
+        self.baseline = None
+        self.baseline_at = None
+
+    def record(self, route: str, peak: int, net: int):
+        entry = self.routes.setdefault(route, {"count": 0, "peak_max": 0, "peak_total": 0, "net_total": 0})
+        entry["count"] += 1
+        entry["peak_max"] = max(entry["peak_max"], peak)
+        entry["peak_total"] += peak
+        entry["net_total"] += net
+
+    @staticmethod
+    def _take() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(MEMORY_SNAPSHOT_FILTERS)
+
+    @staticmethod
+    def _location(traceback: tracemalloc.Traceback) -> Dict[str, Any]:
+        frame = traceback[0]
+        return {
+            "file": frame.filename,
+            "line": frame.lineno,
+            "source": linecache.getline(frame.filename, frame.lineno).strip()
+        }
+
+    def take_baseline(self, limit: int) -> List[Dict[str, Any]]:
+        """Store a snapshot for later diffs and return its largest lines"""
+        snapshot = self._take()
+        self.baseline = snapshot
+        self.baseline_at = datetime.now(timezone.utc).isoformat()
+        return [
+            {**self._location(stat.traceback), "size": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:limit]
+        ]
+
+    def diff(self, limit: int) -> List[Dict[str, Any]]:
+        """Growth per source line since the baseline, largest first"""
+        stats = self._take().compare_to(self.baseline, "lineno")
+        return [
+            {**self._location(stat.traceback), "size_diff": stat.size_diff, "size": stat.size,
+             "count_diff": stat.count_diff, "count": stat.count}
+            for stat in stats[:limit]
+        ]
+
+    def summary(self) -> Dict[str, Any]:
+        current, peak = tracemalloc.get_traced_memory()
+        routes = [
+            {"route": route, "count": entry["count"], "peak_max": entry["peak_max"],
+             "peak_avg": entry["peak_total"] // entry["count"], "net_avg": entry["net_total"] // entry["count"]}
+            for route, entry in self.routes.items()
+        ]
+        routes.sort(key=lambda entry: entry["peak_max"], reverse=True)
+        return {
+            "worker_pid": os.getpid(),
+            "enabled": tracemalloc.is_tracing(),
+            "frames": tracemalloc.get_traceback_limit(),
+            "traced_current": current,
+            "traced_peak": peak,
+            "tracemalloc_overhead": tracemalloc.get_tracemalloc_memory(),
+            "baseline_at": self.baseline_at,
+            "routes": routes
+        }
+
+memory_profiler = MemoryProfiler()
+
+class MemoryProfilerMiddleware:
+    """Records the allocation peak and net change of requests while tracing.
+
+    tracemalloc's peak is process-wide, so one request is measured at a
+    time; allocations by requests overlapping it still count towards its
+    peak, which makes the numbers an upper bound under load.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._active = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self._active or not tracemalloc.is_tracing():
+            await self.app(scope, receive, send)
+            return
+        self._active = True
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._active = False
+            # Tracing may have been switched off by this very request
+            if tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                route = getattr(scope.get("route"), "path", "unmatched")
+                memory_profiler.record(route, peak - before, current - before)
+
+class MemoryTracingUpdate(BaseModel):
+    enabled: bool
+    frames: int = Field(default=MEMORY_TRACE_FRAMES, ge=1, le=100)
+
+@api_router.get("/admin/memory")
+async def get_memory_profile(user: User = Depends(require_admin)):
+    """Traced memory of this worker and per-route allocation deltas in bytes"""
+    return memory_profiler.summary()
+
+@api_router.post("/admin/memory/tracing")
+async def set_memory_tracing(data: MemoryTracingUpdate, user: User = Depends(require_admin)):
+    """Start or stop tracemalloc on this worker"""
+    if data.enabled:
+        memory_profiler.start(data.frames)
+    else:
+        memory_profiler.stop()
+    audit(user, "memory.tracing", "worker", str(os.getpid()), enabled=data.enabled)
+    return memory_profiler.summary()
+
+@api_router.post("/admin/memory/snapshot")
+async def take_memory_snapshot(limit: int = Query(25, ge=1, le=500), user: User = Depends(require_admin)):
+    """Take the baseline snapshot later diffs compare against"""
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="Memory tracing is off")
+    top = await asyncio.to_thread(memory_profiler.take_baseline, limit)
+    audit(user, "memory.snapshot", "worker", str(os.getpid()), baseline_at=memory_profiler.baseline_at)
+    return {"baseline_at": memory_profiler.baseline_at, "top": top}
+
+@api_router.get("/admin/memory/diff")
+async def get_memory_diff(limit: int = Query(25, ge=1, le=500), user: User = Depends(require_admin)):
+    """Allocation growth per source line since the baseline snapshot"""
+    if not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="Memory tracing is off")
+    if memory_profiler.baseline is None:
+        raise HTTPException(status_code=409, detail="No baseline snapshot taken")
+    diff = await asyncio.to_thread(memory_profiler.diff, limit)
+    return {"baseline_at": memory_profiler.baseline_at, "diff": diff}
+
+# ==================== METRICS ENDPOINT ====================
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+mongo_pool_in_use = metrics_registry.register(Gauge(
+    "mongo_pool_connections_in_use", "Connections checked out of the pool", ("address",)
+))
+mongo_pool_open = metrics_registry.register(Gauge(
+    "mongo_pool_connections_open", "Open pool connections", ("address",)
+))
+
+@metrics_registry.collector
+def collect_pool_metrics():
+    snapshot = pool_metrics.snapshot()
+    for address, count in snapshot["in_use"].items():
+        mongo_pool_in_use.set((address,), count)
+    for address, count in snapshot["open"].items():
+        mongo_pool_open.set((address,), count)
+
+class MetricsMiddleware:
+    """Pure ASGI middleware counting requests per route template.
+
+    The route is resolved up front so the in-flight gauge carries the same
+    labels as the counters; unmatched paths share one label to keep the
+    series count bounded.
+    """
+
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+
+    def _route(self, scope) -> str:
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = self._route(scope)
+        labels = (route, scope["method"])
+        status = "500"
+        
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+        
+        http_in_flight.inc(labels)
+        route_token = current_route.set(route)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_route.reset(route_token)
+            http_in_flight.dec(labels)
+            http_request_duration.observe(labels, time.perf_counter() - started)
+            http_requests.inc((route, scope["method"], status))
+
+def has_metrics_token(request: Request) -> bool:
+    # Compare bytes: compare_digest rejects str with non-ASCII characters.
+    # Starlette decodes headers as latin-1, so this gets the raw bytes back.
+    return bool(METRICS_TOKEN) and secrets.compare_digest(
+        request.headers.get("authorization", "").encode("latin-1"), f"Bearer {METRICS_TOKEN}".encode()
+    )
+
+def metrics_response() -> PlainTextResponse:
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+async def metrics(request: Request):
+    """Prometheus text exposition for scrapers inside the cluster"""
+    if METRICS_TOKEN and not has_metrics_token(request):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return metrics_response()
+
+@api_router.get("/metrics", include_in_schema=False)
+async def ingress_metrics(request: Request):
+    """The same exposition through the ingress; always needs the token or an admin session"""
+    if not has_metrics_token(request):
+        await require_admin(request)
+    return metrics_response()
+
 # Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
+async def ensure_indexes():
+    await db.topup_requests.create_index([("status", 1), ("created_at", -1), ("request_id", -1)])
+    await db.topup_requests.create_index([("created_at", -1), ("request_id", -1)])
+    await db.topup_requests.create_index("request_id", unique=True)
+    await db.topup_requests.create_index([("user_id", 1), ("created_at", -1)])
+    await db.counters.create_index("counter_id", unique=True)
+    await db.topup_history.create_index([("user_id", 1), ("created_at", -1)])
+    # Receipts are stored once per content hash; concurrent uploads race on this
+    try:
+        await db["receipts.files"].create_index("filename", unique=True)
+    except OperationFailure:
+        logger.warning("Duplicate receipt files exist; unique index on receipts.files.filename not created")
+    # Buffered writers retry failed batches; unique ids make the retries idempotent
+    for collection, field in (("topup_history", "history_id"), ("audit_log", "audit_id")):
+        try:
+            await db[collection].create_index(field, unique=True, partialFilterExpression={field: {"$type": "string"}})
+        except OperationFailure:
+            logger.warning("Duplicate %s values exist; unique index on %s.%s not created", field, collection, field)
+    try:
+        await db.topup_codes.create_index("code", unique=True)
+    except OperationFailure:
+        logger.warning("Duplicate top-up codes exist; unique index on topup_codes.code not created")
+    await db.topup_codes.create_index([("created_at", 1)])
+    await db.topup_codes.create_index([("batch_id", 1), ("code", 1)], sparse=True)
+    await db.users.create_index([("xp", -1), ("user_id", 1)])
+    for field in USER_SORT_FIELDS:
+        await db.users.create_index([(field, 1), ("user_id", 1)])
+    await db.users.create_index("email_lower")
+    # Every authenticated request looks up its session and then its user
+    await db.user_sessions.create_index("session_token")
+    await db.users.create_index("user_id")
+    await db.orders.create_index("order_id")
+    await db.topup_requests.create_index("receipt_id", sparse=True)
+    await db.topup_requests.create_index("receipt_thumb_url", sparse=True)
+    await db.jobs.create_index("job_id", unique=True)
+    await db.audit_log.create_index([("created_at", -1), ("audit_id", -1)])
+    for field in ("actor_id", "action", "target_type"):
+        await db.audit_log.create_index([(field, 1), ("created_at", -1), ("audit_id", -1)])
+    await db.audit_log.create_index([("target_type", 1), ("target_id", 1), ("created_at", -1), ("audit_id", -1)])
+    await db.jobs.create_index([("status", 1), ("created_at", 1)])
+    await db.jobs.create_index([("created_at", -1)])
+    await db.jobs.create_index("params.batch_id", sparse=True)
+    await db.orders.create_index([("created_at", 1), ("order_id", 1)])
+    await db.orders.create_index([("status", 1), ("created_at", 1), ("order_id", 1)])
+    await db.orders.create_index([("user_id", 1), ("created_at", -1)])
+    await db.users.create_index("name_lower")
+    await db.xp_periods.create_index("user_id", unique=True)
+    await db.stats_rollups.create_index([("granularity", 1), ("bucket", 1)], unique=True)
+    for period in LEADERBOARD_PERIODS:
+        await db.xp_periods.create_index([(f"{period}.key", 1), (f"{period}.xp", -1), ("user_id", 1)])
+    
+    # Users created before prefix search existed get their lowercased copies
+    await db.users.update_many(
+        {"name_lower": {"$exists": False}},
+        [{"$set": {
+            "name_lower": {"$toLower": {"$ifNull": ["$name", ""]}},
+            "email_lower": {"$toLower": {"$ifNull": ["$email", ""]}}
+        }}]
+    )
+    
+    # Sort keys are compared with $gt/$lt, which never match a missing field
+    for field, default in USER_SORT_FIELDS.items():
+        await db.users.update_many({field: None}, {"$set": {field: default}})
+    
+    # Counters are seeded only when missing; an absolute $set here would
+    # overwrite increments made by workers already serving
+    if await db.counters.find_one({"counter_id": PENDING_TOPUP_COUNTER}, {"_id": 1}) is None:
+        pending = await db.topup_requests.count_documents({"status": "pending"})
+        await db.counters.update_one(
+            {"counter_id": PENDING_TOPUP_COUNTER},
+            {"$setOnInsert": {"value": pending}},
+            upsert=True
+        )
+    # /admin/stats/recompute rebuilds the stats counter when it drifts
+    await seed_stats()
+
+# ==================== APP LIFECYCLE ====================
+
+MONGO_WARM_CONNECTIONS = int(os.environ.get('MONGO_WARM_CONNECTIONS', 4))
+WARM_UP_RETRY_SECONDS = float(os.environ.get('WARM_UP_RETRY_SECONDS', 5))
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get('SHUTDOWN_DRAIN_SECONDS', 20))
+DRAIN_TOKEN = os.environ.get('DRAIN_TOKEN')
+
+startup_phase_seconds = metrics_registry.register(Gauge(
+    "app_startup_phase_seconds", "Duration of each startup phase of this worker", ("phase",)
+))
+startup_seconds = metrics_registry.register(Gauge(
+    "app_startup_seconds", "Time from module import until this worker was ready"
+))
+app_ready = metrics_registry.register(Gauge(
+    "app_ready", "1 once warm-up has finished, 0 while warming up or draining"
+))
+
+class InFlightRequests:
+    """Requests being served, so a drain can wait for them to finish"""
+
+    def __init__(self):
+        self.count = 0
+        self.draining = False
+
+in_flight = InFlightRequests()
+
+class DrainMiddleware:
+    """Counts in-flight requests and refuses new ones once draining.
+
+    Draining starts from POST /api/admin/drain, which the pod's preStop
+    hook calls before the server is told to stop; uvicorn itself only runs
+    the lifespan shutdown after it has stopped accepting requests. Refused
+    requests get a 503 with Connection: close so the load balancer retries
+    them elsewhere.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if in_flight.draining:
+            response = JSONResponse(
+                {"detail": "Server is shutting down"},
+                status_code=503,
+                headers={"connection": "close", "retry-after": "1"}
+            )
+            await response(scope, receive, send)
+            return
+        in_flight.count += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            in_flight.count -= 1
+
+async def wait_until(predicate, timeout: float, interval: float = 0.05) -> bool:
+    """Poll predicate until it holds or timeout passes; returns whether it held"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+async def warm_pool(connections: int):
+    """Open connections up front so early requests don't pay for handshakes"""
+    await client.admin.command("ping")
+    # Concurrent pings each check out their own connection
+    connections = min(connections, mongo_options.get("maxPoolSize", 100))
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(connections - 1)))
+
+async def prime_caches():
+    """Load the process caches the storefront and admin pages read on every hit"""
+    await asyncio.gather(
+        wheel_cache.get(),
+        reward_cache.get(),
+        admin_stats_cache.get(),
+        topup_code_filter.start(),
+        leaderboard.start()
+    )
+
+@contextmanager
+def startup_phase(phase: str, timings: Dict[str, float]):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = round(time.perf_counter() - started, 3)
+        startup_phase_seconds.set((phase,), timings[phase])
+
+startup_report: Dict[str, Any] = {"ready": False}
+
+async def warm_up(timings: Dict[str, float]):
+    with startup_phase("connect", timings):
+        await warm_pool(MONGO_WARM_CONNECTIONS)
+    with startup_phase("indexes", timings):
+        await ensure_indexes()
+    with startup_phase("caches", timings):
+        await prime_caches()
+    total = time.perf_counter() - IMPORT_STARTED
+    startup_seconds.set((), total)
+    startup_report.update({"seconds": round(total, 3), "phases": timings})
+    # A retry can finish after a drain began; that worker stays out of rotation
+    if not in_flight.draining:
+        startup_report["ready"] = True
+        app_ready.set((), 1)
+    logger.info("Worker %d ready in %.2fs: %s", os.getpid(), total, timings)
+
+async def retry_warm_up(timings: Dict[str, float]):
+    """Keep trying warm-up while the worker serves not-ready health checks"""
+    while True:
+        await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+        try:
+            await warm_up(timings)
+            return
+        except Exception:
+            logger.exception("Warm-up retry failed")
+
+async def drain_requests(timeout: float, own: int = 0) -> bool:
+    """Refuse new requests and wait for the in-flight ones; own counts the caller's"""
+    app_ready.set((), 0)
+    startup_report["ready"] = False
+    in_flight.draining = True
+    drained = await wait_until(lambda: in_flight.count <= own, timeout)
+    if not drained:
+        logger.warning("%d requests still running at the drain deadline", in_flight.count - own)
+    return drained
+
+async def drain(timeout: float):
+    """Finish in-flight work and flush queues, giving up at the deadline"""
+    deadline = time.monotonic() + timeout
+    
+    def remaining() -> float:
+        return max(0.0, deadline - time.monotonic())
+    
+    await drain_requests(remaining())
+    slow_query_log.stop()
+    topup_code_filter.stop()
+    # Requests are done, so the write buffers won't grow any further
+    for writer in (topup_history_writer, audit_writer):
+        try:
+            await asyncio.wait_for(writer.close(), remaining())
+        except asyncio.TimeoutError:
+            logger.warning("Shutdown deadline passed before %s was flushed", writer.collection_name)
+    await leaderboard.drain(remaining())
+    await job_runner.drain(remaining())
+    if not await wait_until(lambda: not any(pool_metrics.snapshot()["in_use"].values()), remaining()):
+        logger.warning("Closing the Mongo client with connections still checked out")
     client.close()
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=False, cancel_futures=True)
+    if _analytics_pool is not None:
+        _analytics_pool.shutdown(wait=False, cancel_futures=True)
+
+@asynccontextmanager
+async def lifespan(application: FastAPI):
+    """Warm the worker up before it takes traffic and drain it on the way out"""
+    timings: Dict[str, float] = {"import": round(time.perf_counter() - IMPORT_STARTED, 3)}
+    startup_phase_seconds.set(("import",), timings["import"])
+    connect_mongo()
+    warm_up_task = None
+    try:
+        await warm_up(timings)
+    except PyMongoError:
+        # Serve anyway, as the driver reconnects lazily; health stays not-ready
+        # until a retry gets through
+        logger.exception("Warm-up failed; retrying every %ss", WARM_UP_RETRY_SECONDS)
+        warm_up_task = asyncio.create_task(retry_warm_up(timings))
+    # Picks up queued jobs and any whose worker died mid-run
+    job_runner.start()
+    slow_query_log.start()
+    if MEMORY_PROFILING:
+        memory_profiler.start()
+    try:
+        yield
+    finally:
+        if warm_up_task is not None:
+            warm_up_task.cancel()
+        started = time.perf_counter()
+        await drain(SHUTDOWN_DRAIN_SECONDS)
+        logger.info("Worker %d drained in %.2fs", os.getpid(), time.perf_counter() - started)
+
+@api_router.get("/health")
+async def health():
+    """Readiness probe: 503 until warm-up has finished, and from every route while draining"""
+    ready = startup_report["ready"]
+    return JSONResponse(
+        {"status": "ready" if ready else "starting", "worker_pid": os.getpid(), "startup": startup_report},
+        status_code=200 if ready else 503
+    )
+
+@api_router.post("/admin/drain")
+async def drain_worker(request: Request):
+    """Take this worker out of rotation and wait for its in-flight requests.
+
+    Meant for the pod's preStop hook, authenticated with DRAIN_TOKEN; an
+    admin session works too. Returns once drained or at the deadline, and
+    the lifespan shutdown finishes the rest when the server is stopped.
+    """
+    # Raw header bytes, as compare_digest rejects non-ASCII str
+    authorization = request.headers.get("authorization", "").encode("latin-1")
+    if not (DRAIN_TOKEN and secrets.compare_digest(authorization, f"Bearer {DRAIN_TOKEN}".encode())):
+        admin = await require_admin(request)
+        audit(admin, "worker.drain", "worker", str(os.getpid()))
+    drained = await drain_requests(SHUTDOWN_DRAIN_SECONDS, own=1)
+    return {"worker_pid": os.getpid(), "drained": drained, "in_flight": in_flight.count - 1}
+
+def create_app() -> FastAPI:
+    application = FastAPI(title="TSMarket API", lifespan=lifespan)
+    application.add_api_route("/metrics", metrics, include_in_schema=False)
+    application.include_router(api_router)
+    
+    # CORS
+    application.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=["https://summary-ai-2.preview.emergentagent.com", "http://localhost:3000"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    application.add_middleware(MemoryProfilerMiddleware)
+    application.add_middleware(ProfilerMiddleware)
+    # Inside the metrics middleware so refused requests are still counted
+    application.add_middleware(DrainMiddleware)
+    application.add_middleware(MetricsMiddleware, router=application.router)
+    return application
+
+app = create_app()
@@ -3,8 +3,9 @@
 import requests
 import sys
 import json
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 class TSMarketAPITester:
     def __init__(self, base_url="https://summary-ai-2.preview.emergentagent.com"):
@@ -180,6 +181,66 @@ class TSMarketAPITester:
                 else:
                     self.log_test(f"Redeem code {code}", False, f"Status: {response.status_code if response else 'No response'}")
 
+    def test_topup_code_contention(self, users=50, attempts_per_user=10):
+        """Fire many parallel redemptions of one code - exactly one may succeed"""
+        print("\n🏁 Testing Top-up Code Redemption Contention...")
+        
+        if not self.admin_token:
+            self.log_test("Top-up code contention (no admin token)", False, "Admin not logged in")
+            return False
+        
+        code = f"RACE{int(time.time() * 1000)}"
+        response = self.make_request('POST', 'admin/topup-codes', {"code": code, "amount": 1}, token=self.admin_token)
+        if not response or response.status_code != 200:
+            self.log_test("Create contention code", False, f"Status: {response.status_code if response else 'No response'}")
+            return False
+        
+        # Fresh users, each staying within the redemption limiter's burst of 10,
+        # so every attempt reaches the atomic claim instead of getting a 429
+        tokens = []
+        for i in range(users):
+            stamp = f"{int(time.time() * 1000)}_{i}"
+            response = self.make_request('POST', 'auth/register', {
+                "email": f"race{stamp}@test.com",
+                "password": "testpass123",
+                "name": f"Race User {stamp}"
+            })
+            if not response or response.status_code not in [200, 201]:
+                self.log_test("Register contention users", False, f"Status: {response.status_code if response else 'No response'}")
+                return False
+            tokens.append(response.json()['token'])
+        
+        def redeem(token):
+            # One session per thread; requests.Session is not thread-safe
+            try:
+                resp = requests.post(
+                    f"{self.base_url}/api/topup/redeem",
+                    params={'code': code},
+                    headers={'Authorization': f'Bearer {token}'},
+                    timeout=60
+                )
+                return resp.status_code
+            except Exception:
+                return None
+        
+        attempts = [token for token in tokens for _ in range(attempts_per_user)]
+        with ThreadPoolExecutor(max_workers=50) as pool:
+            statuses = list(pool.map(redeem, attempts))
+        
+        successes = statuses.count(200)
+        not_found = statuses.count(404)
+        label = f"Parallel redemption of one code ({len(attempts)} attempts from {users} users)"
+        if successes == 1 and not_found == len(attempts) - 1:
+            self.log_test(label, True)
+            return True
+        
+        unexpected = [s for s in statuses if s not in (200, 404)]
+        self.log_test(
+            label, False,
+            f"{successes} succeeded, {not_found} rejected, other statuses: {sorted(set(map(str, unexpected)))}"
+        )
+        return False
+
     def test_cart_and_checkout(self):
         """Test cart and checkout functionality"""
         print("\n🛒 Testing Cart and Checkout...")
@@ -434,9 +495,19 @@ class TSMarketAPITester:
         else:
             self.log_test("Get admin stats", False, f"Status: {response.status_code if response else 'No response'}")
         
-        # Test get all users
-        users_response = self.make_request('GET', 'admin/users', token=self.admin_token)
-        if users_response and users_response.status_code == 200:
+        # Test stats timeseries for the last week
+        today = datetime.now(timezone.utc).date()
+        response = self.make_request('GET', 'admin/stats/timeseries', token=self.admin_token,
+                                     params={'start': (today - timedelta(days=6)).isoformat(), 'end': today.isoformat()})
+        if response and response.status_code == 200 and len(response.json().get('buckets', [])) == 7:
+            self.log_test("Get stats timeseries", True)
+        else:
+            self.log_test("Get stats timeseries", False, f"Status: {response.status_code if response else 'No response'}")
+        
+        # Test user directory search
+        users_response = self.make_request('GET', 'admin/users', token=self.admin_token,
+                                           params={'q': 'admin@', 'sort': 'xp', 'limit': 10})
+        if users_response and users_response.status_code == 200 and 'items' in users_response.json():
             self.log_test("Get all users", True)
         else:
             self.log_test("Get all users", False, f"Status: {users_response.status_code if users_response else 'No response'}")
@@ -533,11 +604,12 @@ class TSMarketAPITester:
             self.log_test("Admin topup requests (no admin token)", False, "Admin not logged in")
             return False
         
-        # Test get all topup requests
-        response = self.make_request('GET', 'admin/topup-requests', token=self.admin_token)
+        # Test get pending topup requests
+        response = self.make_request('GET', 'admin/topup-requests', params={'status': 'pending'}, token=self.admin_token)
         if response and response.status_code == 200:
-            requests_list = response.json()
-            if isinstance(requests_list, list):
+            page = response.json()
+            requests_list = page.get('items')
+            if isinstance(requests_list, list) and 'pending_count' in page:
                 self.log_test("Get all topup requests", True)
                 
                 # If there are pending requests, test approve/reject
@@ -593,6 +665,30 @@ class TSMarketAPITester:
         else:
             self.log_test("Toggle admin status (grant)", False, f"Status: {response.status_code if response else 'No response'}")
 
+    def test_leaderboard(self):
+        """Test XP leaderboard and own rank"""
+        print("\n🏆 Testing Leaderboard...")
+        
+        response = self.make_request('GET', 'leaderboard', params={'limit': 10})
+        if response and response.status_code == 200:
+            entries = response.json().get('entries', [])
+            ranked = [entry['xp'] for entry in entries] == sorted((entry['xp'] for entry in entries), reverse=True)
+            self.log_test("Get leaderboard", ranked, "" if ranked else "Entries not sorted by XP")
+        else:
+            self.log_test("Get leaderboard", False, f"Status: {response.status_code if response else 'No response'}")
+        
+        response = self.make_request('GET', 'leaderboard', params={'period': 'year'})
+        self.log_test("Reject unknown leaderboard period", bool(response) and response.status_code == 400,
+                      f"Status: {response.status_code if response else 'No response'}")
+        
+        if not self.user_token:
+            return
+        response = self.make_request('GET', 'leaderboard/me', token=self.user_token)
+        if response and response.status_code == 200 and response.json().get('rank'):
+            self.log_test("Get own leaderboard rank", True)
+        else:
+            self.log_test("Get own leaderboard rank", False, f"Status: {response.status_code if response else 'No response'}")
+
     def run_all_tests(self):
         """Run all tests"""
         print("🚀 Starting TSMarket API Tests...")
@@ -629,6 +725,8 @@ class TSMarketAPITester:
         self.test_admin_card_settings()
         self.test_admin_topup_requests_management()
         self.test_admin_user_management()
+        self.test_leaderboard()
+        self.test_topup_code_contention()
         
         return True
 
@@ -21,6 +21,9 @@ api.interceptors.request.use((config) => {
   return config;
 });
 
+// Resolve backend-relative paths (e.g. stored receipts) to absolute URLs
+export const resolveApiUrl = (url) => (url && url.startsWith('/api/') ? `${BACKEND_URL}${url}` : url);
+
 // Auth API
 export const authAPI = {
   register: (data) => api.post('/auth/register', data),
@@ -65,36 +68,62 @@ export const topupAPI = {
 export const rewardsAPI = {
   getAll: () => api.get('/rewards'),
   claim: (level) => api.post(`/rewards/claim/${level}`),
+  claimAll: () => api.post('/rewards/claim-all'),
 };
 
 // Wheel API
 export const wheelAPI = {
   getPrizes: () => api.get('/wheel/prizes'),
-  spin: () => api.post('/wheel/spin'),
+  spin: (count = 1) => api.post('/wheel/spin', null, { params: { count } }),
 };
 
 // Admin API
+export const leaderboardAPI = {
+  get: (period = 'all', limit = 10) => api.get('/leaderboard', { params: { period, limit } }),
+  getMyRank: (period = 'all') => api.get('/leaderboard/me', { params: { period } }),
+};
+
 export const adminAPI = {
   getStats: () => api.get('/admin/stats'),
-  getUsers: () => api.get('/admin/users'),
+  getStatsTimeseries: (start, end, granularity = 'day') => api.get('/admin/stats/timeseries', { params: { start, end, granularity } }),
+  backfillRollups: () => api.post('/admin/stats/rollups/backfill'),
+  getUsers: (params) => api.get('/admin/users', { params }),
+  exportUsers: (params) => api.get('/admin/users/export', { params, responseType: 'blob' }),
   toggleAdmin: (userId, isAdmin) => api.put(`/admin/users/${userId}/admin`, null, { params: { is_admin: isAdmin } }),
-  deleteUser: (userId) => api.delete(`/admin/users/${userId}`),
+  deleteUser: (userId, mode = 'anonymize') => api.delete(`/admin/users/${userId}`, { params: { mode } }),
+  getAuditLog: (params) => api.get('/admin/audit-log', { params }),
+  getPoolMetrics: () => api.get('/admin/db/pool-metrics'),
+  getSlowQueries: (limit = 50) => api.get('/admin/db/slow-queries', { params: { limit } }),
+  getMemoryProfile: () => api.get('/admin/memory'),
+  setMemoryTracing: (enabled) => api.post('/admin/memory/tracing', { enabled }),
+  takeMemorySnapshot: () => api.post('/admin/memory/snapshot'),
+  getMemoryDiff: (limit = 25) => api.get('/admin/memory/diff', { params: { limit } }),
+  getProfiles: () => api.get('/admin/profiles'),
+  getProfile: (profileId, format = 'json') => api.get(`/admin/profiles/${profileId}`, { params: { format } }),
+  getJobs: (params) => api.get('/admin/jobs', { params }),
+  getJob: (jobId) => api.get(`/admin/jobs/${jobId}`),
   updateUserBalance: (userId, balance) => api.put(`/admin/users/${userId}/balance`, null, { params: { balance } }),
   updateUserXP: (userId, xp) => api.put(`/admin/users/${userId}/xp`, null, { params: { xp } }),
   getTopupCodes: () => api.get('/admin/topup-codes'),
   createTopupCode: (data) => api.post('/admin/topup-codes', data),
+  bulkCreateTopupCodes: (data) => api.post('/admin/topup-codes/bulk', data),
+  exportTopupCodeBatch: (batchId) => api.get(`/admin/topup-codes/batches/${batchId}/export`, { responseType: 'blob' }),
   deleteTopupCode: (id) => api.delete(`/admin/topup-codes/${id}`),
   getSettings: () => api.get('/admin/settings'),
   updateSettings: (data) => api.put('/admin/settings', data),
   updateProfile: (data) => api.put('/admin/profile', data),
-  getTopupRequests: () => api.get('/admin/topup-requests'),
+  getTopupRequests: (params) => api.get('/admin/topup-requests', { params }),
   approveTopupRequest: (id) => api.put(`/admin/topup-requests/${id}/approve`),
   rejectTopupRequest: (id, note) => api.put(`/admin/topup-requests/${id}/reject`, null, { params: { note } }),
+  bulkProcessTopupRequests: (requestIds, action, note = '') => api.post('/admin/topup-requests/bulk', { request_ids: requestIds, action, note }),
   createReward: (data) => api.post('/admin/rewards', data),
   deleteReward: (id) => api.delete(`/admin/rewards/${id}`),
   createWheelPrize: (data) => api.post('/admin/wheel-prizes', data),
   deleteWheelPrize: (id) => api.delete(`/admin/wheel-prizes/${id}`),
   getOrders: () => api.get('/admin/orders'),
+  exportOrders: (params) => api.get('/admin/orders/export', { params, responseType: 'blob' }),
+  getAnalyticsReport: (refresh = false) => api.get('/admin/reports/analytics', { params: { refresh } }),
+  migrateReceipts: () => api.post('/admin/migrations/receipts'),
 };
 
 // Seed API
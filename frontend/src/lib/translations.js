@@ -35,6 +35,13 @@ export const translations = {
       readyToLevel: 'Омодаед сатҳ баланд шавед?',
       readyDesc: 'Ба ҳазорҳо геймерҳо ҳамроҳ шавед',
       createAccount: 'Аккаунт созед',
+      leaderboard: 'Беҳтарин бозингарон',
+      leaderboardDesc: 'Рейтинги XP',
+      periodAll: 'Ҳамаи вақт',
+      periodDay: 'Имрӯз',
+      periodWeek: 'Ҳафта',
+      periodMonth: 'Моҳ',
+      yourRank: 'Ҷойи шумо',
     },
     // Catalog
     catalog: {
@@ -260,6 +267,13 @@ export const translations = {
       readyToLevel: 'Готов прокачаться?',
       readyDesc: 'Присоединяйся к тысячам геймеров',
       createAccount: 'Создать аккаунт',
+      leaderboard: 'Лучшие игроки',
+      leaderboardDesc: 'Рейтинг по XP',
+      periodAll: 'Всё время',
+      periodDay: 'Сегодня',
+      periodWeek: 'Неделя',
+      periodMonth: 'Месяц',
+      yourRank: 'Ваше место',
     },
     // Catalog
     catalog: {
@@ -7,7 +7,7 @@ import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '.
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '../components/ui/tabs';
 import { useAuth } from '../context/AuthContext';
 import { useLanguage } from '../context/LanguageContext';
-import { adminAPI, categoriesAPI, productsAPI, rewardsAPI, wheelAPI } from '../lib/api';
+import { adminAPI, categoriesAPI, productsAPI, rewardsAPI, wheelAPI, resolveApiUrl } from '../lib/api';
 import { 
   Settings, Users, Package, Tag, Gift, Sparkles, CreditCard, User,
   Plus, Trash2, ShoppingCart, BarChart3, Loader2, Check, X, Eye, Edit, Clock, CheckCircle, XCircle
@@ -22,10 +22,18 @@ export const Admin = () => {
   const [loading, setLoading] = useState(true);
   const [stats, setStats] = useState(null);
   const [users, setUsers] = useState([]);
+  const [usersCursor, setUsersCursor] = useState(null);
+  const [usersTotal, setUsersTotal] = useState(null);
+  const [userSearch, setUserSearch] = useState('');
+  const [userSort, setUserSort] = useState('created_at');
   const [products, setProducts] = useState([]);
   const [categories, setCategories] = useState([]);
   const [topupCodes, setTopupCodes] = useState([]);
   const [topupRequests, setTopupRequests] = useState([]);
+  const [requestsCursor, setRequestsCursor] = useState(null);
+  const [requestStatus, setRequestStatus] = useState('pending');
+  const [pendingCount, setPendingCount] = useState(0);
+  const [selectedRequests, setSelectedRequests] = useState([]);
   const [rewards, setRewards] = useState([]);
   const [wheelPrizes, setWheelPrizes] = useState([]);
   const [orders, setOrders] = useState([]);
@@ -70,14 +78,14 @@ export const Admin = () => {
     try {
       const [statsRes, usersRes, productsRes, categoriesRes, codesRes, ordersRes, prizesRes, settingsRes, requestsRes] = await Promise.all([
         adminAPI.getStats(),
-        adminAPI.getUsers(),
+        adminAPI.getUsers({ q: userSearch || undefined, sort: userSort }),
         productsAPI.getAll(),
         categoriesAPI.getAll(),
         adminAPI.getTopupCodes(),
         adminAPI.getOrders(),
         wheelAPI.getPrizes(),
         adminAPI.getSettings(),
-        adminAPI.getTopupRequests(),
+        adminAPI.getTopupRequests({ status: requestStatus || undefined }),
       ]);
       
       let rewardsData = [];
@@ -87,7 +95,9 @@ export const Admin = () => {
       } catch (e) {}
 
       setStats(statsRes.data);
-      setUsers(usersRes.data);
+      setUsers(usersRes.data.items);
+      setUsersCursor(usersRes.data.next_cursor);
+      setUsersTotal(usersRes.data.total);
       setProducts(productsRes.data);
       setCategories(categoriesRes.data);
       setTopupCodes(codesRes.data);
@@ -95,7 +105,9 @@ export const Admin = () => {
       setRewards(rewardsData);
       setWheelPrizes(prizesRes.data);
       setAdminSettings(settingsRes.data);
-      setTopupRequests(requestsRes.data);
+      setTopupRequests(requestsRes.data.items);
+      setRequestsCursor(requestsRes.data.next_cursor);
+      setPendingCount(requestsRes.data.pending_count);
     } catch (error) {
       console.error('Failed to fetch data:', error);
       toast.error('Failed to load admin data');
@@ -180,6 +192,74 @@ export const Admin = () => {
   };
 
   // Top-up request handlers
+  const fetchTopupRequests = async (status, cursor = null) => {
+    try {
+      const res = await adminAPI.getTopupRequests({ status: status || undefined, cursor: cursor || undefined });
+      setTopupRequests(cursor ? (prev) => [...prev, ...res.data.items] : res.data.items);
+      setRequestsCursor(res.data.next_cursor);
+      setPendingCount(res.data.pending_count);
+    } catch (error) {
+      toast.error('Failed to load requests');
+    }
+  };
+
+  const fetchUsers = async (cursor = null, q = userSearch, sort = userSort) => {
+    try {
+      const res = await adminAPI.getUsers({ q: q || undefined, sort, cursor: cursor || undefined });
+      setUsers(cursor ? (prev) => [...prev, ...res.data.items] : res.data.items);
+      setUsersCursor(res.data.next_cursor);
+      setUsersTotal(res.data.total);
+    } catch (error) {
+      toast.error('Failed to load users');
+    }
+  };
+
+  const handleUserSearch = (e) => {
+    e.preventDefault();
+    fetchUsers();
+  };
+
+  const handleUserSortChange = (sort) => {
+    setUserSort(sort);
+    fetchUsers(null, userSearch, sort);
+  };
+
+  const handleExportUsers = async (format) => {
+    try {
+      const res = await adminAPI.exportUsers({ format, q: userSearch || undefined, sort: userSort });
+      const url = window.URL.createObjectURL(res.data);
+      const link = document.createElement('a');
+      link.href = url;
+      link.download = `users.${format}`;
+      link.click();
+      window.URL.revokeObjectURL(url);
+    } catch (error) {
+      toast.error('Failed to export users');
+    }
+  };
+
+  const handleRequestStatusChange = (status) => {
+    setRequestStatus(status);
+    setSelectedRequests([]);
+    fetchTopupRequests(status);
+  };
+
+  const toggleRequestSelected = (id) => {
+    setSelectedRequests((prev) => (prev.includes(id) ? prev.filter((r) => r !== id) : [...prev, id]));
+  };
+
+  const handleBulkRequests = async (action) => {
+    const note = action === 'reject' ? prompt('Reason for rejection (optional):') : '';
+    try {
+      const res = await adminAPI.bulkProcessTopupRequests(selectedRequests, action, note || '');
+      toast.success(res.data.message);
+      setSelectedRequests([]);
+      fetchAllData();
+    } catch (error) {
+      toast.error(error.response?.data?.detail || 'Failed to process requests');
+    }
+  };
+
   const handleApproveRequest = async (id) => {
     try {
       await adminAPI.approveTopupRequest(id);
@@ -330,8 +410,6 @@ export const Admin = () => {
     }
   };
 
-  const pendingRequests = topupRequests.filter(r => r.status === 'pending');
-
   if (!isAdmin) return null;
 
   if (loading) {
@@ -381,11 +459,11 @@ export const Admin = () => {
         )}
 
         {/* Pending Requests Alert */}
-        {pendingRequests.length > 0 && (
+        {pendingCount > 0 && (
           <div className="mb-6 p-4 bg-yellow-500/20 border border-yellow-500/50 rounded-xl flex items-center gap-3">
             <Clock className="w-6 h-6 text-yellow-400" />
             <p className="text-yellow-200">
-              <span className="font-bold">{pendingRequests.length}</span> {t('admin.topupRequests')} ожидают проверки!
+              <span className="font-bold">{pendingCount}</span> {t('admin.topupRequests')} ожидают проверки!
             </p>
           </div>
         )}
@@ -395,9 +473,9 @@ export const Admin = () => {
           <TabsList className="bg-slate-800 border border-slate-700 flex-wrap h-auto gap-1 p-1">
             <TabsTrigger value="requests" className="relative" data-testid="tab-requests">
               {t('admin.topupRequests')}
-              {pendingRequests.length > 0 && (
+              {pendingCount > 0 && (
                 <span className="absolute -top-1 -right-1 w-5 h-5 bg-yellow-500 text-black text-xs font-bold rounded-full flex items-center justify-center">
-                  {pendingRequests.length}
+                  {pendingCount}
                 </span>
               )}
             </TabsTrigger>
@@ -413,7 +491,33 @@ export const Admin = () => {
           {/* Top-up Requests Tab */}
           <TabsContent value="requests" className="space-y-6">
             <div className="admin-card">
-              <h3 className="font-bold mb-4">{t('admin.topupRequests')} ({topupRequests.length})</h3>
+              <div className="flex flex-wrap items-center justify-between gap-2 mb-4">
+                <h3 className="font-bold">{t('admin.topupRequests')} ({topupRequests.length})</h3>
+                <div className="flex gap-1" data-testid="request-status-filter">
+                  {['pending', 'approved', 'rejected', ''].map((status) => (
+                    <Button
+                      key={status || 'all'}
+                      size="sm"
+                      variant={requestStatus === status ? 'default' : 'outline'}
+                      onClick={() => handleRequestStatusChange(status)}
+                    >
+                      {status ? t(`topup.status.${status}`) : 'Все'}
+                    </Button>
+                  ))}
+                </div>
+              </div>
+              {selectedRequests.length > 0 && (
+                <div className="flex gap-2 mb-4" data-testid="bulk-request-actions">
+                  <Button onClick={() => handleBulkRequests('approve')} className="bg-green-600 hover:bg-green-700">
+                    <Check className="w-4 h-4 mr-1" />
+                    {t('admin.approve')} ({selectedRequests.length})
+                  </Button>
+                  <Button variant="destructive" onClick={() => handleBulkRequests('reject')}>
+                    <X className="w-4 h-4 mr-1" />
+                    {t('admin.reject')} ({selectedRequests.length})
+                  </Button>
+                </div>
+              )}
               <div className="space-y-4 max-h-[600px] overflow-y-auto">
                 {topupRequests.length === 0 ? (
                   <p className="text-slate-400 text-center py-8">Заявок пока нет</p>
@@ -423,6 +527,15 @@ export const Admin = () => {
                       <div className="flex items-start justify-between gap-4">
                         <div className="flex-1">
                           <div className="flex items-center gap-3 mb-2">
+                            {req.status === 'pending' && (
+                              <input
+                                type="checkbox"
+                                className="w-4 h-4 accent-primary"
+                                checked={selectedRequests.includes(req.request_id)}
+                                onChange={() => toggleRequestSelected(req.request_id)}
+                                data-testid={`select-${req.request_id}`}
+                              />
+                            )}
                             {req.status === 'pending' && <Clock className="w-5 h-5 text-yellow-400" />}
                             {req.status === 'approved' && <CheckCircle className="w-5 h-5 text-green-400" />}
                             {req.status === 'rejected' && <XCircle className="w-5 h-5 text-red-400" />}
@@ -441,9 +554,10 @@ export const Admin = () => {
                         
                         {/* Receipt preview */}
                         {req.receipt_url && (
-                          <a href={req.receipt_url} target="_blank" rel="noopener noreferrer" className="shrink-0">
+                          <a href={resolveApiUrl(req.receipt_url)} target="_blank" rel="noopener noreferrer" className="shrink-0">
                             <img 
-                              src={req.receipt_url} 
+                              src={resolveApiUrl(req.receipt_thumb_url || req.receipt_url)} 
+                              loading="lazy"
                               alt="Receipt" 
                               className="w-24 h-24 object-cover rounded-lg border border-slate-600 hover:border-primary transition-colors"
                             />
@@ -478,6 +592,16 @@ export const Admin = () => {
                     </div>
                   ))
                 )}
+                {requestsCursor && (
+                  <Button
+                    variant="outline"
+                    className="w-full"
+                    onClick={() => fetchTopupRequests(requestStatus, requestsCursor)}
+                    data-testid="requests-load-more"
+                  >
+                    Загрузить ещё
+                  </Button>
+                )}
               </div>
             </div>
           </TabsContent>
@@ -585,7 +709,31 @@ export const Admin = () => {
           {/* Users Tab */}
           <TabsContent value="users" className="space-y-6">
             <div className="admin-card">
-              <h3 className="font-bold mb-4">{t('admin.users')} ({users.length})</h3>
+              <div className="flex flex-wrap items-center justify-between gap-4 mb-4">
+                <h3 className="font-bold">{t('admin.users')} ({usersTotal ?? users.length})</h3>
+                <div className="flex gap-2">
+                  <Button variant="outline" size="sm" onClick={() => handleExportUsers('csv')} data-testid="export-users-csv">CSV</Button>
+                  <Button variant="outline" size="sm" onClick={() => handleExportUsers('ndjson')} data-testid="export-users-ndjson">NDJSON</Button>
+                </div>
+              </div>
+              <form onSubmit={handleUserSearch} className="flex flex-wrap gap-2 mb-4">
+                <Input
+                  value={userSearch}
+                  onChange={(e) => setUserSearch(e.target.value)}
+                  placeholder="Email / name"
+                  className="admin-input flex-1 min-w-[200px]"
+                  data-testid="user-search-input"
+                />
+                <Select value={userSort} onValueChange={handleUserSortChange}>
+                  <SelectTrigger className="admin-input w-40"><SelectValue /></SelectTrigger>
+                  <SelectContent>
+                    <SelectItem value="created_at">Newest</SelectItem>
+                    <SelectItem value="balance">Balance</SelectItem>
+                    <SelectItem value="xp">XP</SelectItem>
+                  </SelectContent>
+                </Select>
+                <Button type="submit" variant="outline" data-testid="user-search-btn">Search</Button>
+              </form>
               <div className="space-y-2 max-h-[500px] overflow-y-auto">
                 {users.map((u) => (
                   <div key={u.user_id} className="flex items-center justify-between p-3 bg-slate-700 rounded-lg" data-testid={`admin-user-${u.user_id}`}>
@@ -633,6 +781,11 @@ export const Admin = () => {
                   </div>
                 ))}
               </div>
+              {usersCursor && (
+                <Button variant="outline" className="w-full mt-4" onClick={() => fetchUsers(usersCursor)} data-testid="users-load-more">
+                  Загрузить ещё
+                </Button>
+              )}
             </div>
           </TabsContent>
 
@@ -1,7 +1,7 @@
 import React, { useEffect, useState } from 'react';
 import { Link } from 'react-router-dom';
 import { Button } from '../components/ui/button';
-import { productsAPI, categoriesAPI, seedAPI } from '../lib/api';
+import { productsAPI, categoriesAPI, seedAPI, leaderboardAPI } from '../lib/api';
 import { useAuth } from '../context/AuthContext';
 import { useCart } from '../context/CartContext';
 import { useLanguage } from '../context/LanguageContext';
@@ -18,6 +18,9 @@ export const Home = () => {
   const [products, setProducts] = useState([]);
   const [categories, setCategories] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [leaderboardPeriod, setLeaderboardPeriod] = useState('all');
+  const [leaders, setLeaders] = useState([]);
+  const [myRank, setMyRank] = useState(null);
 
   useEffect(() => {
     const fetchData = async () => {
@@ -40,6 +43,17 @@ export const Home = () => {
     fetchData();
   }, []);
 
+  useEffect(() => {
+    leaderboardAPI.get(leaderboardPeriod)
+      .then((res) => setLeaders(res.data.entries))
+      .catch((error) => console.error('Failed to fetch leaderboard:', error));
+    if (isAuthenticated) {
+      leaderboardAPI.getMyRank(leaderboardPeriod)
+        .then((res) => setMyRank(res.data.rank))
+        .catch(() => setMyRank(null));
+    }
+  }, [leaderboardPeriod, isAuthenticated]);
+
   const handleAddToCart = (product) => {
     if (!isAuthenticated) {
       toast.error(t('cart.empty'));
@@ -49,6 +63,13 @@ export const Home = () => {
     toast.success(`${product.name} ${t('catalog.addToCart')}!`);
   };
 
+  const leaderboardPeriods = [
+    { value: 'all', labelKey: 'home.periodAll' },
+    { value: 'day', labelKey: 'home.periodDay' },
+    { value: 'week', labelKey: 'home.periodWeek' },
+    { value: 'month', labelKey: 'home.periodMonth' },
+  ];
+
   const features = [
     { icon: Sparkles, titleKey: 'home.earnXP', descKey: 'home.earnXPDesc' },
     { icon: Trophy, titleKey: 'home.levelUp', descKey: 'home.levelUpDesc' },
@@ -247,6 +268,55 @@ export const Home = () => {
         </div>
       </section>
 
+      {/* Leaderboard Section */}
+      <section className="py-20 tsmarket-gradient" data-testid="leaderboard-section">
+        <div className="max-w-3xl mx-auto px-4 sm:px-6 lg:px-8">
+          <div className="text-center mb-8">
+            <h2 className="text-4xl md:text-5xl font-bold tracking-tight mb-4">{t('home.leaderboard')}</h2>
+            <p className="text-lg text-muted-foreground">{t('home.leaderboardDesc')}</p>
+          </div>
+
+          <div className="flex flex-wrap justify-center gap-2 mb-6">
+            {leaderboardPeriods.map((period) => (
+              <Button
+                key={period.value}
+                size="sm"
+                variant={leaderboardPeriod === period.value ? 'default' : 'outline'}
+                className="rounded-full"
+                onClick={() => setLeaderboardPeriod(period.value)}
+                data-testid={`leaderboard-period-${period.value}`}
+              >
+                {t(period.labelKey)}
+              </Button>
+            ))}
+          </div>
+
+          {leaders.length > 0 && (
+            <div className="tsmarket-card divide-y divide-border">
+              {leaders.map((entry) => (
+                <div
+                  key={entry.rank}
+                  className="flex items-center justify-between px-6 py-3"
+                  data-testid={`leaderboard-entry-${entry.rank}`}
+                >
+                  <div className="flex items-center gap-4">
+                    <span className="w-8 text-lg font-black text-primary">#{entry.rank}</span>
+                    <span className="font-bold">{entry.name}</span>
+                  </div>
+                  <span className="category-badge">{entry.xp} XP</span>
+                </div>
+              ))}
+            </div>
+          )}
+
+          {isAuthenticated && myRank && (
+            <p className="text-center mt-4 font-bold" data-testid="leaderboard-my-rank">
+              {t('home.yourRank')}: #{myRank}
+            </p>
+          )}
+        </div>
+      </section>
+
       {/* CTA Section */}
       <section className="py-20 bg-foreground text-background" data-testid="cta-section">
         <div className="max-w-4xl mx-auto px-4 sm:px-6 lg:px-8 text-center">
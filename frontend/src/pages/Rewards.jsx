@@ -50,6 +50,17 @@ export const Rewards = () => {
     }
   };
 
+  const handleClaimAll = async () => {
+    try {
+      const res = await rewardsAPI.claimAll();
+      toast.success(`Claimed ${res.data.rewards.length} rewards!`);
+      await refreshUser();
+      await fetchData();
+    } catch (error) {
+      toast.error(error.response?.data?.detail || 'Failed to claim rewards');
+    }
+  };
+
   const handleSpin = async () => {
     if ((user?.wheel_spins_available || 0) <= 0) {
       toast.error('No spins available');
@@ -84,6 +95,25 @@ export const Rewards = () => {
     }
   };
 
+  const handleSpinAll = async () => {
+    const count = Math.min(user?.wheel_spins_available || 0, 100);
+    if (count <= 1) return;
+
+    setSpinning(true);
+    setSpinResult(null);
+    try {
+      const res = await wheelAPI.spin(count);
+      const { coins_won: coins, xp_won: xp, prizes } = res.data;
+      setSpinResult({ name: `${prizes.length} spins: +${coins} coins, +${xp} XP` });
+      toast.success(`You won ${coins} coins and ${xp} XP!`);
+      await refreshUser();
+    } catch (error) {
+      toast.error(error.response?.data?.detail || 'Spin failed');
+    } finally {
+      setSpinning(false);
+    }
+  };
+
   if (!isAuthenticated) return null;
 
   return (
@@ -192,6 +222,18 @@ export const Rewards = () => {
                 )}
               </Button>
 
+              {(user?.wheel_spins_available || 0) > 1 && (
+                <Button
+                  variant="outline"
+                  className="rounded-full px-8 mt-3"
+                  onClick={handleSpinAll}
+                  disabled={spinning}
+                  data-testid="spin-all-btn"
+                >
+                  Spin all ({Math.min(user.wheel_spins_available, 100)})
+                </Button>
+              )}
+
               {/* Spin Result */}
               {spinResult && !spinning && (
                 <div className="mt-6 p-4 bg-primary/10 rounded-xl text-center animate-pulse-glow" data-testid="spin-result">
@@ -205,10 +247,17 @@ export const Rewards = () => {
 
         {/* Level Rewards */}
         <div className="tsmarket-card p-6" data-testid="level-rewards">
-          <h2 className="text-2xl font-bold mb-6 flex items-center gap-2">
-            <Gift className="w-6 h-6" />
-            Level Rewards
-          </h2>
+          <div className="flex items-center justify-between gap-4 mb-6">
+            <h2 className="text-2xl font-bold flex items-center gap-2">
+              <Gift className="w-6 h-6" />
+              Level Rewards
+            </h2>
+            {rewards.filter((r) => r.can_claim).length > 1 && (
+              <Button className="tsmarket-btn-primary rounded-full" onClick={handleClaimAll} data-testid="claim-all-btn">
+                Claim all
+              </Button>
+            )}
+          </div>
 
           {loading ? (
             <div className="space-y-4">
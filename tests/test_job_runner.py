@@ -0,0 +1,83 @@
+"""Checks that draining the job runner lets polled jobs finish.
+
+Jobs claimed by the poll loop must be tracked like enqueued ones, so a
+drain waits for them up to its timeout instead of cancelling them along
+with the poll loop.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tsmarket_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from server import JobRunner  # noqa: E402
+
+
+class FakeJobs:
+    """Hands out each queued job once and records status updates"""
+
+    def __init__(self, jobs):
+        self.queued = list(jobs)
+        self.updates = []
+
+    async def find_one_and_update(self, query, update, **kwargs):
+        if not self.queued:
+            return None
+        return {**self.queued.pop(0), **update["$set"]}
+
+    async def update_one(self, query, update, **kwargs):
+        self.updates.append((query["job_id"], update["$set"]))
+
+
+class FakeDatabase:
+    def __init__(self, jobs):
+        self.jobs = FakeJobs(jobs)
+
+
+def polled_runner(monkeypatch, job_seconds):
+    database = FakeDatabase([{"job_id": "job_1", "type": "slow", "params": {}}])
+    monkeypatch.setattr(server, "db", database)
+    runner = JobRunner()
+    started = asyncio.Event()
+
+    @runner.register("slow")
+    async def slow(job):
+        started.set()
+        await asyncio.sleep(job_seconds)
+        return {"slept": job_seconds}
+
+    return runner, database, started
+
+
+def test_drain_waits_for_a_polled_job(monkeypatch):
+    async def scenario():
+        runner, database, started = polled_runner(monkeypatch, 0.2)
+        runner.start()
+        await asyncio.wait_for(started.wait(), 1)
+        await runner.drain(2)
+        return database.jobs.updates
+
+    updates = asyncio.run(scenario())
+    assert [(job_id, update["status"]) for job_id, update in updates] == [("job_1", "done")]
+    assert updates[0][1]["result"] == {"slept": 0.2}
+
+
+def test_drain_cancels_a_polled_job_at_the_deadline(monkeypatch):
+    async def scenario():
+        runner, database, started = polled_runner(monkeypatch, 10)
+        runner.start()
+        await asyncio.wait_for(started.wait(), 1)
+        await runner.drain(0.1)
+        # Let the cancellation land before looking at the writes
+        await asyncio.sleep(0)
+        return runner, database.jobs.updates
+
+    runner, updates = asyncio.run(scenario())
+    # No status write, so the lease lapses and another worker resumes it
+    assert updates == []
+    assert not runner._tasks
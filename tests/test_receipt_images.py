@@ -0,0 +1,102 @@
+"""Checks for the receipt normalization step run in the image process pool.
+
+Every accepted upload must come out as a metadata-free RGB JPEG no larger
+than the configured dimensions, and anything that isn't a supported image
+must raise ValueError so the endpoint can answer 400.
+"""
+
+import io
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tsmarket_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from server import (  # noqa: E402
+    RECEIPT_MAX_DIMENSION,
+    RECEIPT_THUMB_DIMENSION,
+    normalize_receipt_image,
+)
+
+RED = (255, 0, 0)
+BLUE = (0, 0, 255)
+
+
+def encode(img, fmt, **params):
+    out = io.BytesIO()
+    img.save(out, fmt, **params)
+    return out.getvalue()
+
+
+def decode(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+
+def assert_close(pixel, expected, tolerance=12):
+    assert all(abs(a - b) <= tolerance for a, b in zip(pixel, expected)), (pixel, expected)
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "PNG", "WEBP", "GIF"])
+def test_supported_formats_become_rgb_jpeg(fmt):
+    result = normalize_receipt_image(encode(Image.new("RGB", (120, 80), RED), fmt))
+    img = decode(result["image"])
+    assert img.format == "JPEG"
+    assert img.mode == "RGB"
+    assert (result["width"], result["height"]) == img.size == (120, 80)
+    assert decode(result["thumbnail"]).format == "JPEG"
+    assert set(result["timings"]) == {"decode", "strip", "downscale", "encode", "thumbnail"}
+
+
+def test_mpo_keeps_the_first_frame():
+    first, second = Image.new("RGB", (64, 48), RED), Image.new("RGB", (64, 48), BLUE)
+    data = encode(first, "MPO", save_all=True, append_images=[second])
+    assert Image.open(io.BytesIO(data)).format == "MPO"
+    img = decode(normalize_receipt_image(data)["image"])
+    assert img.size == (64, 48)
+    assert_close(img.getpixel((32, 24)), RED)
+
+
+def test_large_images_are_downscaled():
+    result = normalize_receipt_image(encode(Image.new("RGB", (RECEIPT_MAX_DIMENSION * 2, 100), RED), "PNG"))
+    assert result["width"] == RECEIPT_MAX_DIMENSION
+    assert max(decode(result["thumbnail"]).size) <= RECEIPT_THUMB_DIMENSION
+
+
+def test_metadata_is_stripped_and_orientation_applied():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees clockwise
+    exif[0x010F] = "PhoneMaker"
+    data = encode(Image.new("RGB", (100, 40), RED), "JPEG", exif=exif.tobytes())
+    img = decode(normalize_receipt_image(data)["image"])
+    assert img.size == (40, 100)
+    assert not img.getexif()
+
+
+def test_transparency_is_flattened_onto_white():
+    data = encode(Image.new("RGBA", (20, 20), (0, 0, 0, 0)), "PNG")
+    img = decode(normalize_receipt_image(data)["image"])
+    assert_close(img.getpixel((10, 10)), (255, 255, 255))
+
+
+def test_unsupported_format_is_rejected():
+    with pytest.raises(ValueError, match="Unsupported"):
+        normalize_receipt_image(encode(Image.new("RGB", (10, 10), RED), "BMP"))
+
+
+def test_garbage_is_rejected():
+    with pytest.raises(ValueError, match="Invalid"):
+        normalize_receipt_image(b"not an image at all")
+
+
+def test_too_many_pixels_is_rejected(monkeypatch):
+    monkeypatch.setattr(server, "RECEIPT_MAX_PIXELS", 100)
+    with pytest.raises(ValueError, match="too large"):
+        normalize_receipt_image(encode(Image.new("RGB", (20, 20), RED), "PNG"))
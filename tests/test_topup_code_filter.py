@@ -0,0 +1,136 @@
+"""Checks for the in-process top-up code guard.
+
+The Bloom filter must never reject a code it was given and should keep its
+false-positive rate near the configured error rate. The guard in front of
+redemption must answer a negative without going to Mongo, and its sync
+should only scan for new codes once another worker has bumped the version.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tsmarket_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from server import BloomFilter, TopUpCodeFilter  # noqa: E402
+
+
+class NoDatabase:
+    """Stands in for server.db where a test expects no query at all"""
+
+    def __getattr__(self, name):
+        raise AssertionError(f"unexpected query on {name}")
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+
+class FakeCodes:
+    def __init__(self, codes):
+        self.codes = codes
+        self.scans = 0
+
+    def find(self, query, projection=None):
+        self.scans += 1
+        return FakeCursor({"code": code} for code in self.codes)
+
+
+class FakeDatabase:
+    def __init__(self, codes):
+        self.topup_codes = FakeCodes(codes)
+
+
+def built_filter(codes, capacity=1000):
+    guard = TopUpCodeFilter()
+    guard.bloom = BloomFilter(capacity, 0.001)
+    for code in codes:
+        guard.add(code)
+    guard.version = 1
+    return guard
+
+
+def use_version(monkeypatch, version):
+    async def get_counter(counter_id):
+        assert counter_id == TopUpCodeFilter.VERSION_COUNTER
+        return version
+    monkeypatch.setattr(server, "get_counter", get_counter)
+
+
+def test_bloom_has_no_false_negatives():
+    bloom = BloomFilter(10_000, 0.001)
+    codes = [f"CODE{i:08d}" for i in range(10_000)]
+    for code in codes:
+        bloom.add(code)
+    assert bloom.count == len(codes)
+    assert all(code in bloom for code in codes)
+
+
+def test_bloom_false_positive_rate_near_target():
+    bloom = BloomFilter(10_000, 0.001)
+    for i in range(10_000):
+        bloom.add(f"CODE{i:08d}")
+    probes = 100_000
+    false_positives = sum(f"MISS{i:08d}" in bloom for i in range(probes))
+    assert false_positives / probes < 0.003
+
+
+def test_empty_bloom_rejects_everything():
+    bloom = BloomFilter(100, 0.001)
+    assert bloom.size >= 64
+    assert "ANYTHING" not in bloom
+
+
+def test_unbuilt_filter_lets_every_code_through(monkeypatch):
+    monkeypatch.setattr(server, "db", NoDatabase())
+    assert TopUpCodeFilter().might_exist("WELCOME100")
+
+
+def test_filter_rejects_unknown_codes_without_a_query(monkeypatch):
+    monkeypatch.setattr(server, "db", NoDatabase())
+    guard = built_filter(["WELCOME100", "DRAGON500"])
+    assert guard.might_exist("WELCOME100")
+    assert guard.might_exist("DRAGON500")
+    assert not guard.might_exist("GUESS12345")
+
+
+def test_sync_skips_the_scan_while_the_version_is_unchanged(monkeypatch):
+    monkeypatch.setattr(server, "db", NoDatabase())
+    use_version(monkeypatch, 1)
+    guard = built_filter(["WELCOME100"])
+    asyncio.run(guard.sync())
+    assert not guard.might_exist("NEWCODE1")
+
+
+def test_sync_picks_up_codes_after_a_version_bump(monkeypatch):
+    database = FakeDatabase(["NEWCODE1"])
+    monkeypatch.setattr(server, "db", database)
+    use_version(monkeypatch, 2)
+    guard = built_filter(["WELCOME100"])
+    asyncio.run(guard.sync())
+    assert database.topup_codes.scans == 1
+    assert guard.version == 2
+    assert guard.might_exist("NEWCODE1")
+    assert guard.might_exist("WELCOME100")
+
+
+@pytest.mark.parametrize("stale, expected", [(0, False), (501, True)])
+def test_rebuild_once_stale_codes_pile_up(stale, expected):
+    guard = built_filter([])
+    guard.stale = stale
+    assert guard._needs_rebuild() is expected
@@ -0,0 +1,86 @@
+"""Statistical checks for the wheel's alias-method sampler.
+
+Each configuration is drawn a couple of million times and every prize's
+observed frequency must sit within 5 standard errors of its configured
+probability, which a correct sampler fails roughly once in 1.7 million runs.
+"""
+
+import math
+import os
+import random
+import sys
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "tsmarket_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from server import AliasSampler  # noqa: E402
+
+DRAWS = 2_000_000
+
+# Probabilities from the seeded wheel in /api/seed
+SEED_WHEEL = [0.3, 0.25, 0.2, 0.1, 0.1, 0.05]
+
+
+def assert_distribution(weights, draws=DRAWS, seed=1234, vectorized=False):
+    sampler = AliasSampler(weights, rng=random.Random(seed))
+    if vectorized:
+        counts = Counter(sampler.draw_many(draws).tolist())
+    else:
+        counts = Counter(sampler.draw() for _ in range(draws))
+    total = sum(weights)
+    for index, weight in enumerate(weights):
+        expected = weight / total
+        observed = counts[index] / draws
+        stderr = math.sqrt(expected * (1 - expected) / draws)
+        assert abs(observed - expected) <= 5 * stderr + 1e-12, (
+            f"prize {index}: observed {observed:.6f}, expected {expected:.6f}"
+        )
+    return counts
+
+
+def test_seed_wheel_distribution():
+    assert_distribution(SEED_WHEEL)
+
+
+def test_unnormalized_weights():
+    # Admins enter probabilities that don't have to sum to 1
+    assert_distribution([3, 1, 1, 5])
+
+
+def test_skewed_distribution():
+    assert_distribution([0.999, 0.0009, 0.0001])
+
+
+def test_many_prizes():
+    rng = random.Random(99)
+    assert_distribution([rng.random() for _ in range(100)])
+
+
+def test_vectorized_seed_wheel_distribution():
+    # Multi-spin draws go through the numpy path
+    assert_distribution(SEED_WHEEL, draws=10_000_000, vectorized=True)
+
+
+def test_vectorized_skewed_distribution():
+    assert_distribution([0.999, 0.0009, 0.0001], draws=10_000_000, vectorized=True)
+
+
+def test_zero_weight_prize_never_drawn():
+    counts = assert_distribution([0.5, 0.0, 0.5], draws=200_000)
+    assert counts[1] == 0
+
+
+def test_single_prize():
+    sampler = AliasSampler([0.2])
+    assert {sampler.draw() for _ in range(1000)} == {0}
+
+
+@pytest.mark.parametrize("weights", [[], [0, 0], [1, -1]])
+def test_invalid_weights(weights):
+    with pytest.raises(ValueError):
+        AliasSampler(weights)